@@ -0,0 +1,66 @@
+"""
+Compare BedGraph pyramid building throughput.
+
+Generates a synthetic BedGraph file and times the legacy, iterrows-based
+`BedGraph.decimate` against the vectorized `BedGraph.build_pyramid`. Only
+decimation is timed; bgzip/tabix are not required.
+
+Usage: python benchmarks/bench_bedgraph_index.py [n_rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from glue_genomics_viewers.data import BedGraph
+
+
+def make_bedgraph(path, n_rows, n_chroms=4, seed=0):
+    rng = np.random.default_rng(seed)
+    per_chrom = n_rows // n_chroms
+    frames = []
+    for i in range(n_chroms):
+        widths = rng.integers(1, 50, per_chrom)
+        start = np.concatenate([[0], np.cumsum(widths)[:-1]])
+        frames.append(pd.DataFrame({
+            'chrom': f'chr{i + 1}',
+            'start': start,
+            'stop': start + widths,
+            'value': rng.gamma(2., 10., per_chrom).round(2),
+        }))
+    pd.concat(frames).to_csv(path, sep='\t', index=False, header=False)
+
+
+def legacy(engine, df):
+    for i in range(engine.depth):
+        factor = engine.downsample_factor ** (i + 1)
+        df = pd.DataFrame(engine.decimate((rec for _, rec in df.iterrows()), factor),
+                          columns=['chrom', 'start', 'stop', 'value'])
+
+
+def vectorized(engine, df):
+    for _ in engine.build_pyramid(df):
+        pass
+
+
+def main(n_rows=200_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bedgraph')
+        make_bedgraph(path, n_rows)
+        size_mb = os.path.getsize(path) / 2 ** 20
+        df = pd.read_csv(path, delimiter='\t', names=['chrom', 'start', 'stop', 'value'])
+        engine = BedGraph(path)
+
+        print(f"{n_rows} rows, {size_mb:.1f} MB")
+        for label, func in [('legacy', legacy), ('vectorized', vectorized)]:
+            t0 = time.perf_counter()
+            func(engine, df)
+            elapsed = time.perf_counter() - t0
+            print(f"{label:>12}: {elapsed:8.3f} s  {size_mb / elapsed:10.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""
+Compare loop decimation speed in BedPe.
+
+Generates synthetic intra-chromosomal loops and times `BedPe.decimate_loops`
+across all levels against the previous ``groupby(...).apply`` merge. The
+legacy path is run on a smaller sample since it is far too slow for
+millions of loops.
+
+Usage: python benchmarks/bench_decimate_loops.py [n_loops] [n_legacy]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from glue_genomics_viewers.data import BedPe
+
+
+def make_loops(n_loops, n_chroms=4, seed=0):
+    rng = np.random.default_rng(seed)
+    chrom = np.sort(rng.integers(1, n_chroms + 1, n_loops))
+    start1 = rng.integers(0, 200_000_000, n_loops)
+    end1 = start1 + rng.integers(500, 5_000, n_loops)
+    start2 = end1 + rng.lognormal(11, 1.5, n_loops).astype(np.int64)
+    end2 = start2 + rng.integers(500, 5_000, n_loops)
+    chrom = np.char.add('chr', chrom.astype(str))
+    df = pd.DataFrame({'chrom1': chrom, 'start1': start1, 'end1': end1,
+                       'chrom2': chrom, 'start2': start2, 'end2': end2,
+                       'value': rng.integers(1, 20, n_loops)})
+    return df.sort_values(['chrom1', 'chrom2', 'start1', 'start2'], ignore_index=True)
+
+
+def legacy_decimate_loops(df, resolution):
+    extent = (df.end2 - df.start1)
+    df = df[extent >= resolution]
+    a = ((df.end1 + df.start1) // 2) // resolution
+    b = ((df.end2 + df.start2) // 2) // resolution
+    df = df.groupby([a, b]).apply(lambda x: x.head(1).assign(value=x.value.sum()))
+    return df.sort_values(['chrom1', 'chrom2', 'start1', 'start2'])
+
+
+def run(decimate, df):
+    t0 = time.perf_counter()
+    for i in range(BedPe.depth):
+        df = decimate(df, BedPe.downsample_factor ** (i + 1))
+    return time.perf_counter() - t0
+
+
+def main(n_loops=10_000_000, n_legacy=100_000):
+    for label, decimate, n in [('legacy', legacy_decimate_loops, n_legacy),
+                               ('vectorized', BedPe.decimate_loops, n_loops)]:
+        df = make_loops(n)
+        elapsed = run(decimate, df)
+        print(f"{label:>12}: {n:>10} loops {elapsed:8.2f} s  {n / elapsed:12.0f} loops/s")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
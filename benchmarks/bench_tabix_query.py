@@ -0,0 +1,48 @@
+"""
+Compare region query latency of the BedGraph tabix backends.
+
+Builds a synthetic, bgzipped and tabix-indexed BedGraph file and times
+random viewport-sized queries with the subprocess and pysam backends.
+Requires the ``bgzip`` and ``tabix`` command line tools, and pysam.
+
+Usage: python benchmarks/bench_tabix_query.py [n_rows] [n_queries]
+"""
+import os
+import sys
+import tempfile
+import time
+from subprocess import check_call
+
+import numpy as np
+
+from glue_genomics_viewers.backends import PysamTabixBackend, TabixSubprocessBackend
+from glue_genomics_viewers.data import GenomeRange
+
+from bench_bedgraph_index import make_bedgraph
+
+
+def main(n_rows=1_000_000, n_queries=200, span=200_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.bedgraph')
+        make_bedgraph(path, n_rows, n_chroms=1)
+        check_call(f"bgzip --stdout {path} > {path}.bgz", shell=True)
+        check_call(['tabix', '-p', 'bed', path + '.bgz'])
+
+        extent = n_rows * 25
+        rng = np.random.default_rng(0)
+        starts = rng.integers(0, extent - span, n_queries)
+        queries = [GenomeRange('chr1', int(s), int(s) + span) for s in starts]
+        columns = ['chrom', 'start', 'stop', 'value']
+
+        for label, backend in [('subprocess', TabixSubprocessBackend()), ('pysam', PysamTabixBackend())]:
+            times = []
+            for gr in queries:
+                t0 = time.perf_counter()
+                backend.query(path + '.bgz', gr, columns)
+                times.append(time.perf_counter() - t0)
+            times = np.array(times) * 1e3
+            print(f"{label:>12}: median {np.median(times):7.2f} ms  p95 {np.percentile(times, 95):7.2f} ms")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,224 @@
+"""
+Query backends for bgzipped, tabix or pairix indexed genomic files.
+
+A backend turns a region query against an indexed file into a DataFrame.
+The in-process backends keep their file handles open between queries, which
+avoids paying for a process launch on every viewport change; the subprocess
+backends only need the command line tools and are used as a fallback.
+
+``columns`` is either a list of column names, or a mapping of column names to
+dtypes which the parsers produce directly (e.g. ``'category'`` chromosomes
+and ``float32`` values), so that results need no conversion afterwards.
+
+Backends also have a ``discard(path)`` method, which `BedGraph.index` and
+`BedPe.index` call for the files they rewrite, so that no handle keeps
+reading a replaced file.
+
+All backends may be used from several threads at once. The in-process
+backends lock each file handle while it is being read, so that different
+files are still queried concurrently.
+"""
+from io import BytesIO, StringIO
+from subprocess import PIPE, run
+from threading import Lock
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['TabixSubprocessBackend', 'PysamTabixBackend', 'default_tabix_backend',
+           'PairixSubprocessBackend', 'PypairixBackend', 'default_pairix_backend']
+
+
+def _region(gr, gr2=None):
+    region = f"{gr.chrom}:{gr.start}-{gr.end}"
+    # Two-dimensional pairix query: first anchor in ``gr``, second in ``gr2``
+    return region if gr2 is None else f"{region}|{_region(gr2)}"
+
+
+def _dtypes(columns):
+    return columns if isinstance(columns, dict) else None
+
+
+def _empty(columns):
+    dtypes = _dtypes(columns) or {}
+    return pd.DataFrame({c: pd.Series([], dtype=dtypes.get(c, object)) for c in columns})
+
+
+def _read_table(buffer, columns):
+    return pd.read_csv(buffer, sep='\t', header=None, names=list(columns), dtype=_dtypes(columns))
+
+
+class TabixSubprocessBackend:
+    """Query tabix-indexed files by running the ``tabix`` command line tool."""
+
+    def query(self, path, gr, columns):
+        logger.debug("%s %s", path, _region(gr))
+        out = run(['tabix', '-f', path, _region(gr)], stdout=PIPE, check=True).stdout
+        if not out:
+            return _empty(columns)
+        return _read_table(BytesIO(out), columns)
+
+    def discard(self, path):
+        """Nothing is kept open between queries."""
+
+
+class PysamTabixBackend:
+    """
+    Query tabix-indexed files in-process with pysam.
+
+    One `pysam.TabixFile` is kept open per path, and the records of a query
+    are parsed in a single `pandas.read_csv` call.
+    """
+
+    def __init__(self):
+        import pysam
+        self._pysam = pysam
+        self._handles = {}
+        self._lock = Lock()
+
+    def _open(self, path):
+        """Return the handle for ``path`` and the lock guarding it."""
+        with self._lock:
+            if path not in self._handles:
+                self._handles[path] = self._pysam.TabixFile(path), Lock()
+            return self._handles[path]
+
+    def query(self, path, gr, columns):
+        logger.debug("%s %s", path, _region(gr))
+        handle, lock = self._open(path)
+        with lock:
+            if gr.chrom not in handle.contigs:
+                return _empty(columns)
+            # tabix regions are 1-based and inclusive, pysam uses 0-based half-open
+            lines = list(handle.fetch(gr.chrom, max(gr.start - 1, 0), gr.end))
+        if not lines:
+            return _empty(columns)
+        return _read_table(StringIO('\n'.join(lines)), columns)
+
+    def discard(self, path):
+        """Close the handle of ``path``, e.g. after the file was rewritten by an index build."""
+        with self._lock:
+            entry = self._handles.pop(path, None)
+        if entry is not None:
+            handle, lock = entry
+            with lock:
+                handle.close()
+
+    def close(self):
+        with self._lock:
+            for handle, lock in self._handles.values():
+                with lock:
+                    handle.close()
+            self._handles.clear()
+
+
+_default_tabix_backend = None
+_default_lock = Lock()
+
+
+def default_tabix_backend():
+    """Return a shared `PysamTabixBackend`, or `TabixSubprocessBackend` if pysam is missing."""
+    global _default_tabix_backend
+    with _default_lock:
+        if _default_tabix_backend is None:
+            try:
+                _default_tabix_backend = PysamTabixBackend()
+            except ImportError:
+                logger.info("pysam is not installed, falling back to the tabix command line tool")
+                _default_tabix_backend = TabixSubprocessBackend()
+        return _default_tabix_backend
+
+
+class PairixSubprocessBackend:
+    """Query pairix-indexed files by running the ``pairix`` command line tool."""
+
+    def query(self, path, gr, columns, gr2=None):
+        logger.debug("%s %s", path, _region(gr, gr2))
+        out = run(['pairix', '-f', path, _region(gr, gr2)], stdout=PIPE, check=True).stdout
+        if not out:
+            return _empty(columns)
+        return _read_table(BytesIO(out), columns)
+
+    def discard(self, path):
+        """Nothing is kept open between queries."""
+
+
+class PypairixBackend:
+    """
+    Query pairix-indexed files in-process with pypairix.
+
+    One handle is kept open per path (i.e. per decimation level), and records
+    are converted column by column from a single string array rather than
+    parsed row by row.
+    """
+
+    def __init__(self):
+        import pypairix
+        self._pypairix = pypairix
+        self._handles = {}
+        self._lock = Lock()
+
+    def _open(self, path):
+        """Return the handle for ``path`` and the lock guarding it."""
+        with self._lock:
+            if path not in self._handles:
+                self._handles[path] = self._pypairix.open(path), Lock()
+            return self._handles[path]
+
+    def query(self, path, gr, columns, gr2=None):
+        logger.debug("%s %s", path, _region(gr, gr2))
+        handle, lock = self._open(path)
+        with lock:
+            records = list(handle.querys2D(_region(gr, gr2)))
+        if not records:
+            return _empty(columns)
+        table = np.array(records, dtype=str)[:, :len(columns)]
+        dtypes = _dtypes(columns) or {}
+        return pd.DataFrame({name: _typed(table[:, i], dtypes.get(name)) for i, name in enumerate(columns)})
+
+    def discard(self, path):
+        """Drop the handle of ``path``, e.g. after the file was rewritten by an index build."""
+        with self._lock:
+            entry = self._handles.pop(path, None)
+        if entry is not None:
+            # Wait for a query still reading the handle; it is released when garbage collected
+            with entry[1]:
+                pass
+
+    def close(self):
+        # pypairix handles are released when garbage collected
+        with self._lock:
+            self._handles.clear()
+
+
+def _typed(column, dtype=None):
+    """Convert a column of strings to ``dtype``, or to integers or floats where possible."""
+    if dtype == 'category':
+        return pd.Categorical(column)
+    if dtype is not None:
+        return column.astype(dtype)
+    for dtype in (np.int64, np.float64):
+        try:
+            return column.astype(dtype)
+        except ValueError:
+            pass
+    return column.astype(object)
+
+
+_default_pairix_backend = None
+
+
+def default_pairix_backend():
+    """Return a shared `PypairixBackend`, or `PairixSubprocessBackend` if pypairix is missing."""
+    global _default_pairix_backend
+    with _default_lock:
+        if _default_pairix_backend is None:
+            try:
+                _default_pairix_backend = PypairixBackend()
+            except ImportError:
+                logger.info("pypairix is not installed, falling back to the pairix command line tool")
+                _default_pairix_backend = PairixSubprocessBackend()
+        return _default_pairix_backend
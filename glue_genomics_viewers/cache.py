@@ -0,0 +1,77 @@
+"""
+An in-memory LRU cache of query tiles.
+
+`BedGraph.query` and `BedPe.query` split the genome into fixed-size tiles
+per zoom level and fetch whole tiles, so that panning and zooming back and
+forth is served from memory instead of re-querying the index. Tiles are
+evicted least recently used first once the cache exceeds its memory budget.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+__all__ = ['TileCache', 'TILE_CACHE']
+
+
+class TileCache:
+    """
+    LRU cache of DataFrame tiles, bounded by their total memory usage.
+
+    Keys are tuples whose first element is the path of the level file the
+    tile was read from, followed by whatever else distinguishes the tile
+    (storage, chromosome, tile size and position); see `discard`.
+
+    Parameters
+    ----------
+    memory_budget: Approximate upper bound, in bytes, on the memory used by cached tiles.
+    """
+
+    def __init__(self, memory_budget=256 * 2 ** 20):
+        self.memory_budget = memory_budget
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, fetch):
+        """Return the tile for ``key``, calling ``fetch()`` to load it on a miss."""
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key][0]
+            self.misses += 1
+
+        tile = fetch()
+        nbytes = int(tile.memory_usage(index=True, deep=True).sum())
+
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile, nbytes
+                self.nbytes += nbytes
+            while self.nbytes > self.memory_budget and len(self._tiles) > 1:
+                _, (_, evicted) = self._tiles.popitem(last=False)
+                self.nbytes -= evicted
+        return tile
+
+    def discard(self, path):
+        """Drop all tiles of the level file at ``path``, e.g. after it was rebuilt."""
+        with self._lock:
+            for key in [key for key in self._tiles if key[0] == path]:
+                self.nbytes -= self._tiles.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Hit and miss counters, number of tiles and bytes currently cached."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'tiles': len(self._tiles), 'nbytes': self.nbytes}
+
+
+#: Cache shared by all engines by default
+TILE_CACHE = TileCache()
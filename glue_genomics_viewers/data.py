@@ -1,15 +1,20 @@
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
-from subprocess import check_call, PIPE, Popen
+from functools import partial, reduce
+from subprocess import check_call
 import os
+import shutil
 import logging
 
 import numpy as np
 import pandas as pd
 from glue.core import Data
 
-from .subsets import GenomicRangeSubsetState, GenomicMulitRangeSubsetState
-
-from ncls import NCLS #For fast overlaps
+from .backends import default_tabix_backend, default_pairix_backend
+from .cache import TILE_CACHE
+from .manifest import IndexManifest
+from .store import MemmapStore, MemmapStoreWriter
+from .subsets import GenomicRangeSubsetState, GenomicMulitRangeSubsetState, genomic_ranges
 
 
 logger = logging.getLogger(__name__)
@@ -30,60 +35,483 @@ class BedGraph:
     of aggregation files located in a `.glue_index` folder parallel to the original file.
 
     The current implementation is restricted to simple, single-attribute files.
+    Each decimated level stores several summary statistics of the bins it
+    aggregates (see `summarize` and `stats`), so that any of them can be
+    displayed from the same index.
 
     Parameters
     ----------
     path: Path to a local BedGraph file
     downsample_factor: How much each successive aggregation downsamples the previous pass.
     depth: How many passes of downsampling to create and index.
+    storage: How the levels are stored. ``'tabix'`` writes bgzipped, tabix-indexed
+        text files; ``'memmap'`` writes memory-mapped binary columns (see
+        `glue_genomics_viewers.store`), which are faster to query.
+    backend: Query backend for tabix storage (see `glue_genomics_viewers.backends`).
+        Defaults to an in-process pysam reader, or the tabix command line tool
+        if pysam is not installed.
+    tile_cache: `glue_genomics_viewers.cache.TileCache` serving queries by
+        tiles of ``tile_bins`` bins of the queried level, or `None` to query
+        the index directly.
     """
     path: str
+    storage: str = 'tabix'
     downsample_factor = 10
     depth = 5
-
-    def index(self):
+    backend = None
+    memory_budget = 512 * 2 ** 20
+    tile_cache = TILE_CACHE
+    tile_bins = 1000
+
+    columns = ['chrom', 'start', 'stop', 'value']
+    # Decimated levels: ``value`` is the maximum, ``min`` the minimum, ``sum``
+    # the length-weighted sum of values, ``count`` the number of source
+    # intervals and ``bases`` the number of bases they cover.
+    level_columns = columns + ['min', 'sum', 'count', 'bases']
+    stats = ('max', 'min', 'mean', 'sum', 'count')
+
+    _dtypes = {'chrom': str, 'start': np.int64, 'stop': np.int64, 'value': np.float64,
+               'min': np.float64, 'sum': np.float64, 'count': np.int64, 'bases': np.int64}
+    # Query results are parsed straight into compact types
+    _result_dtypes = {'chrom': 'category', 'start': np.int64, 'stop': np.int64, 'value': np.float32,
+                      'min': np.float32, 'sum': np.float64, 'count': np.int64, 'bases': np.int64}
+    # How each column combines when intervals are merged into a bin
+    _reducers = {'start': np.minimum, 'stop': np.maximum, 'value': np.maximum,
+                 'min': np.minimum, 'sum': np.add, 'count': np.add, 'bases': np.add}
+
+    # Rough peak footprint of one parsed row while it is being decimated,
+    # used to turn `memory_budget` into a chunk size when streaming.
+    _bytes_per_row = 400
+
+    def index(self, streaming=None, memory_budget=None, workers=1):
         """
         Aggregate and downsample raw data.
 
-        This operation is currently very slow (10+ minutes / GB)
+        Every level is built from the previous one with a vectorized
+        reduction (see `build_pyramid`), so the cost is dominated by
+        reading the source file and by bgzip/tabix.
+
+        Builds are incremental: a manifest (see `glue_genomics_viewers.manifest`)
+        records the source file and the output of every level, and only
+        missing or invalid levels are rebuilt, starting from the last valid
+        level before them. A changed source file invalidates all levels.
+
+        Parameters
+        ----------
+        streaming: Read the source file in chunks rather than all at once, so that
+            peak memory is bounded by ``memory_budget`` instead of the file size.
+            By default, streaming is used for files whose parsed rows would not
+            fit in the budget (see `_bytes_per_row`).
+        memory_budget: Approximate memory budget in bytes for streaming mode.
+            Defaults to `memory_budget`.
+        workers: Number of processes to use for a full build. With more than
+            one worker, each chromosome is decimated in its own process (always
+            streaming, with the budget shared between workers), and the levels
+            are compressed and indexed in parallel.
         """
+        memory_budget = memory_budget or self.memory_budget
         os.makedirs(os.path.join(os.path.dirname(self.path), '.glue_index'), exist_ok=True)
-        outpaths = [self._level_path(i) for i in range(self.depth)]
-        if all(os.path.exists(p + '.bgz.tbi') for p in outpaths):
+
+        manifest = self.manifest
+        if manifest.source_changed():
+            manifest.reset()
+        levels = [None] + list(range(self.depth))
+        stale = [level for level in levels if not manifest.level_valid(level, self._level_files(level))]
+        if not stale:
             logger.debug("Already indexed")
+            manifest.save()
             return
 
-        df = pd.read_csv(self.path, delimiter='\t', names=['chr', 'stop', 'start', 'value'])
-        check_call(f"bgzip --stdout {self.path} > {self.path}.bgz", shell=True)
-        check_call(['tabix', '-p', 'bed', self.path + '.bgz'])
+        for level in stale:
+            manifest.invalidate(level)
+        manifest.save()
+        logger.info("Indexing %s (levels %s)", self.path, stale)
 
-        downsample_factors = [self.downsample_factor ** (i + 1) for i in range(self.depth)]
-        for path, factor in zip(outpaths, downsample_factors):
-            decimated = pd.DataFrame(self.decimate((rec for _, rec in df.iterrows()), factor),
-                                     columns=['chrom', 'start', 'stop', 'value'])
-            decimated.to_csv(path, sep='\t', index=False, header=False)
-            df = decimated
+        if streaming is None:
+            streaming = self._estimate_rows() * self._bytes_per_row > memory_budget
+        chunksize = max(1, memory_budget // self._bytes_per_row) if streaming else None
 
-            check_call(f"bgzip --stdout {path} > {path}.bgz", shell=True)
-            check_call(['tabix', '-p', 'bed', path + ".bgz"])
+        if workers > 1 and len(stale) == len(levels):
+            self._index_parallel(workers, memory_budget)
+        else:
+            self._index_levels(stale, chunksize)
+
+        for level in stale:
+            manifest.record(level, self._level_files(level))
+        manifest.save()
+        self._names = None
+        if self.storage != 'memmap':
+            # Handles kept open on the rewritten files would read stale offsets
+            backend = self.backend or default_tabix_backend()
+            for level in stale:
+                backend.discard(self._level_path(level) + '.bgz')
+        if self.tile_cache is not None:
+            for level in stale:
+                self.tile_cache.discard(self._level_path(level))
+
+    def _index_levels(self, levels, chunksize):
+        """Rebuild ``levels``, starting from the valid level preceding the first of them."""
+        memmap = self.storage == 'memmap'
+        decimated = [level for level in levels if level is not None]
+        if memmap:
+            writer = self.store.writer(levels)
+        else:
+            writer = _TabixWriter({level: self._level_path(level) for level in decimated})
+
+        if memmap and None in levels and (not decimated or decimated[0] > 0):
+            for chunk in self._chunks(None, chunksize):
+                writer.write(None, chunk)
+
+        if decimated:
+            first = decimated[0]
+            if first == 0:
+                chunks = self._write_raw(self._chunks(None, chunksize), writer)
+            else:
+                chunks = self._chunks(first - 1, chunksize)
+            # Valid levels between stale ones are recomputed but not written
+            for level, df in self.stream_pyramid(chunks, start=first, stop=decimated[-1] + 1):
+                writer.write(level, df)
+        writer.close()
+
+        if not memmap:
+            for source, dest in self._tabix_jobs(levels):
+                _bgzip_tabix(source, dest)
+
+    def _chunks(self, level, chunksize):
+        """Read ``level``, or the source file for `None`, in chunks of ``chunksize`` rows (or whole)."""
+        if level is not None and self.storage == 'memmap':
+            return self.store.iter_level(level, chunksize)
+        chunks = self._read(level, chunksize=chunksize)
+        return [chunks] if chunksize is None else chunks
+
+    def _index_parallel(self, workers, memory_budget):
+        chunksize = max(1, memory_budget // workers // self._bytes_per_row)
+        rows = self._chromosome_rows()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            if self.storage == 'memmap':
+                writer = self.store.writer()
+                futures = [pool.submit(_index_bedgraph_rows, self, offset, count, chunksize, None)
+                           for _, offset, count in rows]
+                for future in futures:
+                    writer.update(*future.result())
+                writer.close()
+                return
+
+            outpaths = {level: self._level_path(level) for level in range(self.depth)}
+            parts = [{level: f'{path}.part{i}' for level, path in outpaths.items()} for i in range(len(rows))]
+            futures = [pool.submit(_index_bedgraph_rows, self, offset, count, chunksize, paths)
+                       for (_, offset, count), paths in zip(rows, parts)]
+            for future in futures:
+                future.result()
+
+            for level, path in outpaths.items():
+                _concatenate([paths[level] for paths in parts], path)
+
+            list(pool.map(_bgzip_tabix, *zip(*self._tabix_jobs([None] + list(outpaths)))))
+
+    def _tabix_jobs(self, levels):
+        """(source, destination) pairs to bgzip and index for ``levels``."""
+        jobs = []
+        for level in levels:
+            path = self._level_path(level)
+            jobs.append((self.path if level is None else path, path))
+        return jobs
+
+    def _level_files(self, level):
+        """The files making up ``level``, as recorded in the manifest."""
+        if self.storage == 'memmap':
+            return self.store.level_files(level)
+        path = self._level_path(level)
+        files = [path + '.bgz', path + '.bgz.tbi']
+        # Decimated levels keep their text file, to rebuild the next level from
+        return files if level is None else [path] + files
+
+    def _estimate_rows(self, sample=2 ** 16):
+        """Estimate the number of rows of the source file from the line length of its first bytes."""
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            head = f.read(sample)
+        lines = head.count(b'\n')
+        return size if not lines else size * lines // len(head)
+
+    def _chromosome_rows(self, blocksize=2 ** 24):
+        """
+        Return ``(chrom, offset, n_rows)`` for each chromosome of the source
+        file, where ``offset`` is the byte offset of its first row.
+
+        The file is scanned in blocks of ``blocksize`` bytes without being
+        parsed: only the rows where the chromosome changes are decoded.
+        """
+        rows = []
+        position = 0
+        rest = b''
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(blocksize)
+                data = rest + block
+                if block:
+                    end = data.rfind(b'\n') + 1
+                    data, rest = data[:end], data[end:]
+                elif data and not data.endswith(b'\n'):
+                    data += b'\n'
+                if data:
+                    self._scan_chromosomes(data, position, rows)
+                    position += len(data)
+                if not block:
+                    return rows
+
+    def _scan_chromosomes(self, data, position, rows):
+        """Add the rows of ``data``, complete lines starting at byte ``position``, to ``rows``."""
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        starts = np.r_[0, np.flatnonzero(buffer[:-1] == ord('\n')) + 1]
+        i = 0
+        while i < len(starts):
+            if rows:
+                # Length of the run of lines starting with the current chromosome
+                prefix = np.frombuffer((rows[-1][0] + '\t').encode(), dtype=np.uint8)
+                same = np.ones(len(starts) - i, dtype=bool)
+                for k, byte in enumerate(prefix):
+                    same &= buffer[np.minimum(starts[i:] + k, len(buffer) - 1)] == byte
+                n = len(same) if same.all() else int(np.argmin(same))
+                rows[-1][2] += n
+                i += n
+                if i == len(starts):
+                    break
+            start = int(starts[i])
+            chrom = data[start:data.index(b'\t', start)].decode()
+            if any(chrom == row[0] for row in rows):
+                raise ValueError(f"{self.path} is not sorted by chromosome ({chrom} is split)")
+            rows.append([chrom, position + start, 0])
 
     @staticmethod
-    def _tabix_query(path, gr: GenomeRange):
-        query = f"{gr.chrom}:{gr.start}-{gr.end}"
-        logger.debug("%s %s", path, query)
-        p = Popen(['tabix', '-f', path, query], stdout=PIPE)
-        for line in p.stdout:
-            line = line.decode('utf-8')
-            yield line.strip().split('\t')
+    def _write_raw(chunks, writer):
+        for chunk in chunks:
+            writer.write(None, chunk)
+            yield chunk
+
+    @property
+    def store(self):
+        """The `MemmapStore` used when ``storage='memmap'``."""
+        if getattr(self, '_store', None) is None:
+            a, b = os.path.split(self.path)
+            self._store = MemmapStore(os.path.join(a, '.glue_index', '%s.memmap_%i' % (b, self.downsample_factor)))
+        return self._store
+
+    @property
+    def manifest(self):
+        """The `IndexManifest` of the levels built by `index`."""
+        a, b = os.path.split(self.path)
+        path = os.path.join(a, '.glue_index', '%s.manifest_%s_%i.json' % (b, self.storage, self.downsample_factor))
+        return IndexManifest(path, self.path, {'storage': self.storage,
+                                               'downsample_factor': self.downsample_factor,
+                                               'depth': self.depth,
+                                               'columns': self.level_columns})
 
-    def query(self, gr: GenomeRange, samples: int = 1000):
+    def _read(self, level=None, chunksize=None, nrows=None, buffer=None):
+        """
+        Read the source file, or the text file of a decimated ``level``.
+
+        ``buffer`` is an open file of the source to read from instead, e.g.
+        positioned at the first row of a chromosome.
+        """
+        if level is None:
+            path, names, precision = self.path, self.columns, None
+        else:
+            # Levels written by `index` must read back exactly, to rebuild the next level from
+            path, names, precision = self._level_path(level), self.level_columns, 'round_trip'
+        return pd.read_csv(path if buffer is None else buffer, delimiter='\t', names=names,
+                           dtype={c: self._dtypes[c] for c in names}, float_precision=precision,
+                           chunksize=chunksize, nrows=nrows)
+
+    def build_pyramid(self, df):
+        """
+        Yield each of the `depth` decimation levels of ``df`` in turn.
+
+        Level ``i`` aggregates into bins of ``downsample_factor ** (i + 1)``
+        and is computed from level ``i - 1`` rather than from the raw data.
+
+        Parameters
+        ----------
+        df: DataFrame with ``chrom``, ``start``, ``stop`` and ``value`` columns,
+            sorted by position within each chromosome.
+        """
+        for i in range(self.depth):
+            df = self.decimate_frame(df, self.downsample_factor ** (i + 1))
+            yield df
+
+    def stream_pyramid(self, chunks, start=0, stop=None):
+        """
+        Out-of-core version of `build_pyramid`.
+
+        Consumes an iterable of consecutive DataFrame chunks and yields
+        ``(level, frame)`` pieces as soon as they are final. At each level the
+        rows falling in the last, still open, bin of a chunk are carried over
+        and prepended to the next chunk, so the output is identical to
+        decimating the whole file at once.
 
+        Only levels ``start`` to ``stop`` (exclusive, defaults to `depth`) are
+        built; ``chunks`` must then hold level ``start - 1`` rather than the
+        raw data.
+        """
+        levels = range(start, self.depth if stop is None else stop)
+        carry = {i: None for i in levels}
+        for df in chunks:
+            for i in levels:
+                step = self.downsample_factor ** (i + 1)
+                if carry[i] is not None:
+                    df = pd.concat([carry[i], df], ignore_index=True)
+                df, carry[i] = self._split_open_bin(df, step)
+                df = self.decimate_frame(df, step)
+                yield i, df
+
+        df = None
+        for i in levels:
+            pending = [piece for piece in (carry[i], df) if piece is not None]
+            if not pending:
+                break
+            df = self.decimate_frame(pd.concat(pending, ignore_index=True),
+                                     self.downsample_factor ** (i + 1))
+            yield i, df
+
+    @staticmethod
+    def _split_open_bin(df, step):
+        """Split sorted intervals into those in closed bins and those sharing the last bin."""
+        if df.empty:
+            return df, None
+        chrom = df['chrom'].to_numpy()
+        bins = df['start'].to_numpy() // step
+        closed = np.flatnonzero((chrom != chrom[-1]) | (bins != bins[-1]))
+        split = closed[-1] + 1 if len(closed) else 0
+        return df.iloc[:split], df.iloc[split:]
+
+    @staticmethod
+    def summarize(df):
+        """Add the summary columns of decimated levels to raw BedGraph rows, unless already present."""
+        if 'min' in df:
+            return df
+        value = df['value'].to_numpy(np.float64)
+        bases = (df['stop'] - df['start']).to_numpy(np.int64)
+        return df.assign(min=value, sum=value * bases, count=np.ones(len(df), dtype=np.int64), bases=bases)
+
+    @classmethod
+    def statistic(cls, df, stat):
+        """Return the ``stat`` summary statistic (one of `stats`) of each row of a query result."""
+        if stat not in cls.stats:
+            raise ValueError(f"Unknown statistic {stat!r}, expected one of {cls.stats}")
+        df = cls.summarize(df)
+        if stat == 'max':
+            result = df['value']
+        elif stat == 'mean':
+            result = df['sum'] / df['bases']
+        else:
+            result = df[stat]
+        return result.astype(np.float32)
+
+    @classmethod
+    def decimate_frame(cls, df, step):
+        """
+        Vectorized equivalent of `decimate`.
+
+        Intervals are grouped by chromosome and ``start // step``; each group
+        is reduced to a single interval spanning its members. All summary
+        columns are reduced in the same pass: ``value`` and ``min`` keep the
+        extreme values of the members, ``sum``, ``count`` and ``bases`` add
+        up. Intervals longer than ``step`` are passed through unchanged.
+        """
+        df = cls.summarize(df)
+        codes, chroms = pd.factorize(df['chrom'], sort=False)
+        start = df['start'].to_numpy(np.int64)
+        stop = df['stop'].to_numpy(np.int64)
+
+        long = (stop - start) > step
+        short = ~long
+
+        s_codes = codes[short]
+        bins = start[short] // step
+        boundary = np.ones(len(bins), dtype=bool)
+        boundary[1:] = (s_codes[1:] != s_codes[:-1]) | (bins[1:] != bins[:-1])
+        first = np.flatnonzero(boundary)
+
+        out_codes = np.concatenate([s_codes[first], codes[long]])
+        out = {}
+        for column, reducer in cls._reducers.items():
+            values = df[column].to_numpy(cls._dtypes[column])
+            out[column] = np.concatenate([reducer.reduceat(values[short], first), values[long]])
+
+        order = np.lexsort((out['start'], out_codes))
+        return pd.DataFrame({'chrom': chroms.take(out_codes[order]),
+                             **{column: out[column][order] for column in cls.level_columns[1:]}})
+
+    def query(self, gr: GenomeRange, samples: int = 1000):
+        """
+        Return the intervals overlapping ``gr`` from the coarsest level that
+        still resolves about ``samples`` points. Decimated levels include the
+        summary columns of `level_columns`; the raw level, and levels indexed
+        before those columns existed, only `columns`.
+        """
         resolution = (gr.end - gr.start) / (samples * 2)
         level = max((i for i in range(self.depth) if self.downsample_factor ** (i + 1) <= resolution),
                     default=None)
+        if self.tile_cache is None:
+            return self._query_level(level, gr)
+
+        width = self.tile_bins * (1 if level is None else self.downsample_factor ** (level + 1))
+        first = gr.start // width
+        # Keyed on the level file, so engines differing in downsample_factor,
+        # tile_bins or storage do not share tiles
+        key = self._level_path(level), self.storage, gr.chrom, width
+        tiles = [self.tile_cache.get(key + (t,),
+                                     partial(self._query_tile, level, gr.chrom, t, width))
+                 for t in range(first, gr.end // width + 1)]
+
+        # Tiles hold the intervals overlapping them that start before their
+        # end; past the first tile, keep only those starting in the tile.
+        parts = [tile if t == first else tile[tile['start'].to_numpy() >= t * width]
+                 for t, tile in enumerate(tiles, first)]
+        parts = [part for part in parts if not part.empty] or tiles[:1]
+        df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        return df[(df['start'] <= gr.end) & (df['stop'] >= gr.start)].reset_index(drop=True)
+
+    def _query_tile(self, level, chrom, tile, width):
+        df = self._query_level(level, GenomeRange(chrom, tile * width, (tile + 1) * width))
+        return df[df['start'] < (tile + 1) * width].reset_index(drop=True)
+
+    def _query_level(self, level, gr: GenomeRange):
+        names = self._level_names(level)
+        dtypes = {c: self._result_dtypes[c] for c in names}
+        if self.storage == 'memmap':
+            df = self.store.query(level, gr)
+            # Only the value columns are narrowed, the rest is already typed
+            return df.astype({c: d for c, d in dtypes.items() if c in df and c != 'chrom'})
+
         path = self._level_path(level) + '.bgz'
-        return pd.DataFrame(self._tabix_query(path, gr), columns=['chrom', 'start', 'stop', 'value']).apply(
-            pd.to_numeric, errors='ignore')
+        backend = self.backend or default_tabix_backend()
+        return backend.query(path, gr, dtypes)
+
+    def _level_names(self, level):
+        """
+        The columns stored in ``level``.
+
+        Tabix levels written before the summary columns were added only hold
+        `columns`. They are still queried, with `summarize` standing in for
+        the missing statistics, until `index` rebuilds them.
+        """
+        if level is None or self.storage == 'memmap':
+            # Memmap stores return the columns they hold
+            return self.columns if level is None else self.level_columns
+        if getattr(self, '_names', None) is None:
+            self._names = {}
+        if level not in self._names:
+            names = self.level_columns
+            path = self._level_path(level)
+            if os.path.exists(path):
+                with open(path) as f:
+                    if len(f.readline().split('\t')) == len(self.columns):
+                        logger.warning("%s has no summary statistics, run index() to rebuild it", path)
+                        names = self.columns
+            self._names[level] = names
+        return self._names[level]
 
     def _level_path(self, level):
         a, b = os.path.split(self.path)
@@ -146,69 +574,390 @@ class BedGraph:
             yield chrom, lo, hi, current_max / (hi - lo)
 
 
+class _TabixWriter:
+    """Write decimation levels as tab-separated BED files, ready for bgzip/tabix."""
+
+    def __init__(self, outpaths):
+        self._handles = {level: open(path, 'w') for level, path in outpaths.items()}
+
+    def write(self, level, df):
+        # The raw level is the source file itself, so there is nothing to write;
+        # levels without an output path are not being rebuilt.
+        if level in self._handles:
+            df.to_csv(self._handles[level], sep='\t', index=False, header=False)
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+
+
+def _bgzip_tabix(source, dest):
+    check_call(f"bgzip --stdout {source} > {dest}.bgz", shell=True)
+    check_call(['tabix', '-p', 'bed', dest + '.bgz'])
+
+
+def _bgzip_pairix(source, dest, sort=False):
+    sort = "sort -k1,1 -k4,4 -k2,2n -k5,5n" if sort else "cat"
+    check_call(f"{sort} {source} | bgzip > {dest}.bgz", shell=True)
+    logger.info("pairix %s", dest)
+    check_call(
+        ['pairix', '-f', '-s', '1', '-d', '4', '-b', '2', '-e', '3', '-u', '5', '-v', '6', dest + '.bgz'])
+
+
+def _concatenate(parts, path):
+    """Concatenate and remove the per-chromosome ``parts`` of a level file."""
+    with open(path, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+
+
+def _decimate_bedpe(engine, df, outpaths):
+    """
+    Write decimation levels of the loops in ``df`` to ``outpaths``.
+
+    ``outpaths`` maps levels to paths, and ``df`` holds the level before the
+    first of them (or the raw loops). Runs in a worker process for
+    `BedPe.index`, and returns the loop density tables of the written levels.
+    """
+    density = {}
+    for level in range(min(outpaths), max(outpaths) + 1):
+        df = engine.decimate_loops(df, engine.downsample_factor ** (level + 1))
+        if level not in outpaths:
+            continue
+        df.to_csv(outpaths[level], sep='\t', index=False, header=False)
+        for chrom, table in engine.loop_density(df, engine.density_bin).items():
+            density[f'{level}|{chrom}'] = table
+    return density
+
+
+def _run_now(func, *args, **kwargs):
+    """Run ``func`` immediately, with the same interface as `Executor.submit`."""
+    future = Future()
+    future.set_result(func(*args, **kwargs))
+    return future
+
+
+def _index_bedgraph_rows(engine, offset, nrows, chunksize, outpaths):
+    """
+    Decimate ``nrows`` rows of a BedGraph file, starting at byte ``offset``.
+
+    Runs in a worker process for `BedGraph.index`. Levels are written to
+    ``outpaths``, or straight into the engine's memmap store if that is
+    `None`, in which case the store metadata is returned for merging.
+    """
+    writer = MemmapStoreWriter(engine.store, clear=False) if outpaths is None else _TabixWriter(outpaths)
+    with open(engine.path, 'rb') as f:
+        f.seek(offset)
+        chunks = engine._read(chunksize=chunksize, nrows=nrows, buffer=f)
+        for level, decimated in engine.stream_pyramid(engine._write_raw(chunks, writer)):
+            writer.write(level, decimated)
+    if outpaths is None:
+        return writer.dtypes, writer.chroms
+    writer.close()
+
+
 @dataclass
 class BedPe:
     """
     Utility to aggregate, downsample, and query BedPe files.
 
     Currently restricted to single-attribute datasets.
+
+    Parameters
+    ----------
+    path: Path to a local BedPe file
+    backend: Query backend (see `glue_genomics_viewers.backends`). Defaults to
+        an in-process pypairix reader, or the pairix command line tool if
+        pypairix is not installed.
+    tile_cache: `glue_genomics_viewers.cache.TileCache` serving queries by
+        two-dimensional tiles of anchor positions, or `None` to query the
+        index directly.
     """
     path: str
     downsample_factor = 10
     depth = 7
+    backend = None
+    tile_cache = TILE_CACHE
+    # Bin size, in bp, of the per-level loop density tables used to pick a level
+    density_bin = 100_000
+
+    columns = ['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2', 'value']
+    # Query results are parsed straight into compact types
+    _result_dtypes = {'chrom1': 'category', 'start1': np.int64, 'end1': np.int64,
+                      'chrom2': 'category', 'start2': np.int64, 'end2': np.int64, 'value': np.float32}
 
-    def index(self):
+    def index(self, workers=1):
+        """
+        Aggregate and downsample raw loops.
+
+        Like `BedGraph.index`, builds are incremental: only levels missing
+        from the manifest or whose files changed are rebuilt, from the text
+        file of the last valid level before them.
+
+        Parameters
+        ----------
+        workers: Number of processes to use. With more than one worker, each
+            chromosome is decimated in its own process, and the levels are
+            compressed and indexed in parallel.
+        """
         os.makedirs(os.path.join(os.path.dirname(self.path), '.glue_index'), exist_ok=True)
-        outpaths = [self._level_path(i) for i in range(self.depth)]
-        if all(os.path.exists(p + '.bgz.px2') for p in outpaths):
+
+        manifest = self.manifest
+        if manifest.source_changed():
+            manifest.reset()
+        stale = [level for level in [None] + list(range(self.depth))
+                 if not manifest.level_valid(level, self._level_files(level))]
+        density_valid = manifest.level_valid('density', [self._density_path()])
+        if not stale and density_valid:
             logger.debug("Already indexed")
+            manifest.save()
             return
 
-        df = pd.read_csv(self.path, delimiter='\t',
-                         names=['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2', 'value'])
-        df = df.sort_values(['chrom1', 'chrom2', 'start1', 'start2'])
+        for level in stale + ['density']:
+            manifest.invalidate(level)
+        manifest.save()
+        logger.info("Indexing %s (levels %s)", self.path, stale)
 
-        assert (df.start2 >= df.end1).all()  # all loops are sorted
-        assert (df.chrom1 == df.chrom2).all()  # all loops are intra-chromosomal
+        outpaths = {level: self._level_path(level) for level in stale if level is not None}
+        if not outpaths:
+            df = None
+        elif min(outpaths) > 0:
+            df = self._read(self._level_path(min(outpaths) - 1))
+        else:
+            df = self._read(self.path)
+            df = df.sort_values(['chrom1', 'chrom2', 'start1', 'start2'])
 
-        check_call(f"sort -k1,1 -k4,4 -k2,2n -k5,5n {self.path} | bgzip  > {self.path}.bgz", shell=True)
-        check_call(
-            ['pairix', '-f', '-s', '1', '-d', '4', '-b', '2', '-e', '3', '-u', '5', '-v', '6', self.path + '.bgz'])
+            assert (df.start2 >= df.end1).all()  # all loops are sorted
+            assert (df.chrom1 == df.chrom2).all()  # all loops are intra-chromosomal
 
-        downsample_factors = [self.downsample_factor ** (i + 1) for i in range(self.depth)]
-        for path, factor in zip(outpaths, downsample_factors):
-            df = self.decimate_loops(df, factor)
-            df.to_csv(path, sep='\t', index=False, header=False)
+        if df is None:
+            groups, parts = [], []
+        elif workers > 1:
+            groups = [loops for _, loops in df.groupby('chrom1', sort=True)]
+            parts = [{level: f'{path}.part{i}' for level, path in outpaths.items()} for i in range(len(groups))]
+        else:
+            groups, parts = [df], [outpaths]
 
-            check_call(f"bgzip --stdout {path} > {path}.bgz", shell=True)
-            logger.info("pairix", path)
-            check_call(
-                ['pairix', '-f', '-s', '1', '-d', '4', '-b', '2', '-e', '3', '-u', '5', '-v', '6', path + '.bgz'])
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            submit = pool.submit if pool else _run_now
+            jobs = []
+            if None in stale:
+                jobs.append(submit(_bgzip_pairix, self.path, self._level_path(None), sort=True))
+            decimated = [submit(_decimate_bedpe, self, loops, paths) for loops, paths in zip(groups, parts)]
+
+            density = {}
+            for future in decimated:
+                density.update(future.result())
+
+            if len(parts) > 1:
+                for level, path in outpaths.items():
+                    _concatenate([paths[level] for paths in parts], path)
+
+            jobs += [submit(_bgzip_pairix, path, path) for path in outpaths.values()]
+            for future in jobs:
+                future.result()
+        finally:
+            if pool:
+                pool.shutdown()
+
+        # Density tables of the levels that were not rebuilt are kept, or
+        # recomputed from their text files if the tables themselves are stale
+        self._density = None
+        previous = self.density if density_valid else None
+        for level in range(self.depth):
+            if level in outpaths:
+                continue
+            if previous is not None:
+                density.update({key: table for key, table in previous.items()
+                                if key.split('|')[0] == str(level)})
+            else:
+                tables = self.loop_density(self._read(self._level_path(level)), self.density_bin)
+                density.update({f'{level}|{chrom}': table for chrom, table in tables.items()})
+
+        np.savez(self._density_path(), **density)
+        self._density = None
+
+        for level in stale:
+            manifest.record(level, self._level_files(level))
+        manifest.record('density', [self._density_path()])
+        manifest.save()
+        # Handles kept open on the rewritten files would read stale offsets
+        backend = self.backend or default_pairix_backend()
+        for level in stale:
+            backend.discard(self._level_path(level) + '.bgz')
+        if self.tile_cache is not None:
+            for level in stale:
+                self.tile_cache.discard(self._level_path(level))
+
+    def _read(self, path):
+        return pd.read_csv(path, delimiter='\t', names=self.columns)
+
+    @property
+    def manifest(self):
+        """The `IndexManifest` of the levels built by `index`."""
+        a, b = os.path.split(self.path)
+        path = os.path.join(a, '.glue_index', '%s.manifest_%i.json' % (b, self.downsample_factor))
+        return IndexManifest(path, self.path, {'downsample_factor': self.downsample_factor,
+                                               'depth': self.depth,
+                                               'density_bin': self.density_bin})
+
+    def _level_files(self, level):
+        """The files making up ``level``, as recorded in the manifest."""
+        path = self._level_path(level)
+        files = [path + '.bgz', path + '.bgz.px2']
+        # Decimated levels keep their text file, to rebuild the next level from
+        return files if level is None else [path] + files
 
     @staticmethod
-    def _pairix_query(path, gr: GenomeRange, verbose):
-        query = f"{gr.chrom}:{gr.start}-{gr.end}"
+    def loop_density(df, bin_size):
+        """
+        Count loops per pair of genomic bins.
+
+        Returns a dictionary mapping each chromosome to a ``(3, N)`` array of
+        anchor 1 bin, anchor 2 bin and loop count, sorted by bin.
+        """
+        result = {}
+        for chrom, loops in df.groupby('chrom1', sort=False):
+            bins = np.stack([loops.start1.to_numpy() // bin_size,
+                             loops.start2.to_numpy() // bin_size], axis=1)
+            pairs, counts = np.unique(bins, axis=0, return_counts=True)
+            result[chrom] = np.vstack([pairs.T, counts])
+        return result
+
+    def _density_path(self):
+        a, b = os.path.split(self.path)
+        return os.path.join(a, '.glue_index', '%s.density_%i_%i.npz' % (b, self.downsample_factor, self.density_bin))
+
+    @property
+    def density(self):
+        """Loop density tables written by `index`, or `None` for older indexes."""
+        if getattr(self, '_density', None) is None:
+            path = self._density_path()
+            if not os.path.exists(path):
+                return None
+            with np.load(path) as tables:
+                self._density = dict(tables)
+        return self._density
+
+    def estimate_count(self, level, gr: GenomeRange):
+        """
+        Estimate how many loops a query of ``level`` over ``gr`` returns.
+
+        Both anchors of a loop must fall in ``gr``; bins straddling the edges
+        of the range are counted in proportion to their overlap with it. Loops
+        with both anchors in the same bin are mostly shorter than the bin, so
+        that when one anchor is in range the other usually is too: those are
+        counted in proportion to the overlap of the bin, not its square.
+        """
+        table = self.density.get(f'{level}|{gr.chrom}')
+        if table is None:
+            return 0
+
+        size = self.density_bin
+        bin1, bin2, counts = table
+        lo = np.searchsorted(bin1, gr.start // size)
+        hi = np.searchsorted(bin1, gr.end // size, side='right')
+        bin1, bin2, counts = bin1[lo:hi], bin2[lo:hi], counts[lo:hi]
+
+        inside = bin2 <= gr.end // size
+        bin1, bin2, counts = bin1[inside], bin2[inside], counts[inside]
+
+        def overlap(bins):
+            return (np.minimum((bins + 1) * size, gr.end) - np.maximum(bins * size, gr.start)).clip(0) / size
+
+        fraction = overlap(bin1)
+        fraction = np.where(bin1 == bin2, fraction, fraction * overlap(bin2))
+        return float((counts * fraction).sum())
+
+    def _query_level(self, level, gr: GenomeRange, verbose):
+        if self.tile_cache is None:
+            return self._query_pairix(level, gr, None, verbose)
+
+        # Tiles are squares of (anchor 1, anchor 2) positions, at least half
+        # as wide as the query and a power of two so that they are shared
+        # between nearby views.
+        width = 2 ** int(np.ceil(np.log2(max(gr.end - gr.start, 2) / 2)))
+        first, last = gr.start // width, gr.end // width
+
+        parts = []
+        for i in range(first, last + 1):
+            for j in range(i, last + 1):
+                tile = self.tile_cache.get((self._level_path(level), self.downsample_factor, gr.chrom, (width, i, j)),
+                                           partial(self._query_tile, level, gr.chrom, width, i, j, verbose))
+                # Keep loops once: in the tile of their anchor starts, or in the
+                # first row or column if they start before the queried tiles.
+                keep = np.ones(len(tile), dtype=bool)
+                if i > first:
+                    keep &= tile['start1'].to_numpy() >= i * width
+                if j > first:
+                    keep &= tile['start2'].to_numpy() >= j * width
+                if keep.any():
+                    parts.append(tile[keep])
+
+        if not parts:
+            return self._empty()
+        df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+        inside = ((df['start1'] <= gr.end) & (df['end1'] >= gr.start) &
+                  (df['start2'] <= gr.end) & (df['end2'] >= gr.start))
+        return df[inside].reset_index(drop=True)
+
+    def _query_tile(self, level, chrom, width, i, j, verbose):
+        df = self._query_pairix(level, GenomeRange(chrom, i * width, (i + 1) * width),
+                                GenomeRange(chrom, j * width, (j + 1) * width), verbose)
+        return df[(df['start1'] < (i + 1) * width) & (df['start2'] < (j + 1) * width)].reset_index(drop=True)
+
+    def _empty(self):
+        return pd.DataFrame({c: pd.Series([], dtype=d) for c, d in self._result_dtypes.items()})
+
+    def _level_empty(self, level, chrom):
+        """Whether decimated ``level`` has no loops on ``chrom``, according to the index."""
+        if level is None:
+            return False
+        if self.density is not None:
+            return f'{level}|{chrom}' not in self.density
+        path = self._level_path(level)
+        return os.path.exists(path) and os.path.getsize(path) == 0
+
+    def _query_pairix(self, level, gr: GenomeRange, gr2, verbose):
+        # Coarse levels are often empty, and pypairix can abort the whole
+        # process on an empty file, so those are never opened
+        if self._level_empty(level, gr.chrom):
+            return self._empty()
+        path = self._level_path(level) + '.bgz'
         if verbose:
-            logger.info("%s %s", path, query)
-        p = Popen(['pairix', '-f', path, query], stdout=PIPE)
-        for line in p.stdout:
-            line = line.decode('utf-8')
-            yield line.strip().split('\t')
+            logger.info("%s %s:%s-%s", path, gr.chrom, gr.start, gr.end)
+        backend = self.backend or default_pairix_backend()
+        if gr2 is None:
+            return backend.query(path, gr, self._result_dtypes)
+        return backend.query(path, gr, self._result_dtypes, gr2=gr2)
 
     def query(self, gr: GenomeRange, target=100, level=None, verbose=True):
         last = None
 
         if level is not None:
-            path = self._level_path(level) + '.bgz'
-            return pd.DataFrame(self._pairix_query(path, gr, verbose),
-                                columns=['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2', 'value']).apply(
-                pd.to_numeric, errors='ignore')
+            return self._query_level(level, gr, verbose)
+
+        if self.density is not None:
+            # Pick the finest level whose predicted size (and that of every
+            # coarser level) stays within target, then read only that level.
+            level = self.depth - 1
+            for i in range(self.depth)[::-1]:
+                if self.estimate_count(i, gr) > target:
+                    break
+                level = i
+            df = self._query_level(level, gr, verbose)
+            # The estimate is coarser than the bins of fine levels: if it was
+            # too low, step back up to the first level within target
+            while len(df) > target and level < self.depth - 1:
+                level += 1
+                df = self._query_level(level, gr, verbose)
+            return df
 
         for level in range(self.depth)[::-1]:
-            path = self._level_path(level) + '.bgz'
-            df = pd.DataFrame(self._pairix_query(path, gr, verbose),
-                              columns=['chrom1', 'start1', 'end1', 'chrom2', 'start2', 'end2', 'value']).apply(
-                pd.to_numeric, errors='ignore')
+            df = self._query_level(level, gr, verbose)
             if len(df) > target:
                 return last if last is not None else df
             last = df
@@ -230,19 +979,35 @@ class BedPe:
         # Remove loops with extents below the resolution
         df = df[extent >= resolution]
 
-        # Merge loops that overlap given the resolution
-        a = ((df.end1 + df.start1) // 2) // resolution
-        b = ((df.end2 + df.start2) // 2) // resolution
-        df = df.groupby([a, b]).apply(lambda x: x.head(1).assign(value=x.value.sum()))
+        # Merge loops that overlap given the resolution: loops whose anchor
+        # midpoints share a pair of bins keep the coordinates of the first
+        # of them and the sum of their values.
+        codes, _ = pd.factorize(df.chrom1)
+        a = (((df.end1 + df.start1) // 2) // resolution).to_numpy()
+        b = (((df.end2 + df.start2) // 2) // resolution).to_numpy()
 
-        return df.sort_values(['chrom1', 'chrom2', 'start1', 'start2'])
+        order = np.lexsort((b, a, codes))
+        a, b, codes = a[order], b[order], codes[order]
+        boundary = np.ones(len(order), dtype=bool)
+        boundary[1:] = (codes[1:] != codes[:-1]) | (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+        first = np.flatnonzero(boundary)
+
+        value = np.add.reduceat(df.value.to_numpy()[order], first)
+        keep = order[first]
+
+        # Loops are intra-chromosomal and chromosomes are already in sorted
+        # order, so sorting by chromosome code and anchor starts is enough.
+        resort = np.lexsort((df.start2.to_numpy()[keep], df.start1.to_numpy()[keep], codes[first]))
+        merged = df.iloc[keep[resort]].reset_index(drop=True)
+        merged['value'] = value[resort]
+        return merged
 
 
 class GenomicData(Data):
     """Base Data class for wrap Genomic files in Glue."""
     engine_cls = None
 
-    def __init__(self, path, **kwargs):
+    def __init__(self, path, engine_options=None, **kwargs):
 
         kwargs.setdefault('label', os.path.splitext(os.path.split(path)[-1])[0])
         # The task of making a true Glue data object entirely divorced from numpy arrays
@@ -255,26 +1020,55 @@ class GenomicData(Data):
         super().__init__(**kwargs)
 
         self.path = path
-        self.engine = self.engine_cls(self.path)
+        self.engine = self.engine_cls(self.path, **(engine_options or {}))
 
     def profile(self, chr, start, end, subset_state=None, **kwargs):
         raise NotImplementedError
 
+    def _genomic_ranges(self, subset_state):
+        """
+        Evaluate ``subset_state``, e.g. a selection in a linked table, to the
+        genomic ranges it selects on the datasets of its collection.
+
+        As in `GenomeTrackLayerState.fetch`, the datasets are those of the
+        subset groups: every group has one subset per dataset.
+        """
+        datasets = None
+        for subset in self.subsets:
+            group = getattr(subset, 'group', None)
+            if group is not None:
+                datasets = [s.data for s in group.subsets]
+                break
+        return genomic_ranges(subset_state, datasets)
+
 
 class BedgraphData(GenomicData):
     """Glue Data wrapper for BedGraph files."""
 
     engine_cls = BedGraph
 
-    def profile(self, chr, start, end, subset_state=None, **kwargs):
-        
+    def profile(self, chr, start, end, subset_state=None, stat='max', **kwargs):
+        """
+        Return the intervals of chromosome ``chr`` between ``start`` and ``end``.
+
+        ``stat`` selects the summary statistic (one of `BedGraph.stats`)
+        reported in the ``value`` column. All statistics are stored in every
+        level, so switching between them needs no re-index. With ``stat=None``
+        the summary columns are returned as they are, for the caller to pick
+        from with `BedGraph.statistic`.
+        """
         query_chrom = f'chr{chr}'
         query_start = int(start)
         query_end   = int(end)
         
         result = self.engine.query(GenomeRange(query_chrom, query_start, query_end))
+        if stat is not None:
+            result = result.assign(value=self.engine.statistic(result, stat))
         if subset_state is None:
             return result
+        if not isinstance(subset_state, (GenomicRangeSubsetState, GenomicMulitRangeSubsetState)):
+            # e.g. a linked selection in a table: filter by the genomic ranges it selects
+            subset_state = self._genomic_ranges(subset_state)
 
         if isinstance(subset_state, GenomicRangeSubsetState):
             c, s, e = subset_state.chrom, subset_state.start, subset_state.end
@@ -284,18 +1078,12 @@ class BedgraphData(GenomicData):
                 result.stop.le(e)
             ]
         elif isinstance(subset_state, GenomicMulitRangeSubsetState): 
-            mask = result.chrom.eq('junk')
-            for c,s,e in zip(subset_state.chroms, subset_state.starts, subset_state.ends):
-                if (c != query_chrom) or (s > query_end) or (e < query_start):
-                    continue #Avoid making a really long query
-                else:
-                    mask |= result.chrom.eq(c) & result.start.ge(s) & result.stop.le(e) #This assumes an OR state, but it could be more complicated
+            # Intervals contained in a range; only the ranges in view are searched
+            mask = subset_state.contains(query_chrom, result.start.to_numpy(), result.stop.to_numpy(),
+                                         window=(query_start, query_end))
             return result.loc[mask]
         else:
-            #try:
-            #    subset_state.to_index_list()
-            #except:
-            # TODO: implement more general subset filtering.
+            # Not expressible as genomic ranges
             return result.head(0)
 
 
@@ -311,6 +1099,9 @@ class BedPeData(GenomicData):
         #print(len(result))
         if subset_state is None:
             return result
+        if not isinstance(subset_state, (GenomicRangeSubsetState, GenomicMulitRangeSubsetState)):
+            # e.g. a linked selection in a table: filter by the genomic ranges it selects
+            subset_state = self._genomic_ranges(subset_state)
 
         if isinstance(subset_state, GenomicRangeSubsetState):
             c, s, e = subset_state.chrom, subset_state.start, subset_state.end
@@ -327,20 +1118,17 @@ class BedPeData(GenomicData):
                 )
             ]
         elif isinstance(subset_state, GenomicMulitRangeSubsetState):
-            # A bit convoluted but reasonably performant
-            ncls1 = NCLS(result.start1,result.end1,result.index.values) #Assumes we're in the right chromosome
-            ncls2 = NCLS(result.start2,result.end2,result.index.values)
-            
-            #We could first filter to remove subset_states outside the range entirely
-            subset_indices = pd.Series(list(range(len(subset_state.starts)))) #NCLS requires this, though we could do it in the subset object
-            subset_starts = pd.Series(subset_state.starts)
-            subset_ends = pd.Series(subset_state.ends)
-            
-            l_idxs_1, r_idxs_1 = ncls1.all_overlaps_both(subset_starts.values, subset_ends.values, subset_indices.values)
-            l_idxs_2, r_idxs_2 = ncls2.all_overlaps_both(subset_starts.values, subset_ends.values, subset_indices.values)
-            both_ends = list(set(r_idxs_1) | set(r_idxs_2))
-            return result.loc[both_ends]
+            # Loops with either anchor overlapping a range, using the NCLS cached on the subset state
+            hits = [np.empty(0, dtype=np.int64)]
+            for anchor in ('1', '2'):
+                chroms = result['chrom' + anchor].astype(object).to_numpy()
+                for c in pd.unique(chroms):
+                    rows = np.flatnonzero(chroms == c)
+                    found = subset_state.overlaps(c, result['start' + anchor].to_numpy()[rows],
+                                                  result['end' + anchor].to_numpy()[rows])
+                    hits.append(rows[found])
+            return result.iloc[reduce(np.union1d, hits)]
 
         else:
-            # TODO: implement more general subset filtering.
+            # Not expressible as genomic ranges
             return result.head(0)
\ No newline at end of file
@@ -1,3 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+
 import pandas as pd
 import numpy as np
 from matplotlib.axes._axes import _TransformedBoundsLocator
@@ -5,16 +9,28 @@ from matplotlib.axes._axes import _TransformedBoundsLocator
 from glue.core import Data
 from glue.viewers.matplotlib.layer_artist import MatplotlibLayerArtist
 from glue.utils import defer_draw
-from matplotlib.patches import Arc
+from matplotlib.collections import LineCollection, PolyCollection
 
 from .state import GenomeTrackLayerState
 
+logger = logging.getLogger(__name__)
+
+#: Worker threads shared by all tracks, so that they fetch concurrently
+FETCH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='genome-track-fetch')
+
 
 class GenomeTrackLayerArtist(MatplotlibLayerArtist):
     _layer_state_cls = GenomeTrackLayerState
 
+    #: Callable running a function on the GUI thread. Viewers that set it get
+    #: data fetched in `FETCH_POOL`; otherwise data is fetched synchronously.
+    dispatch = None
+
     def __init__(self, axes, viewer_state, layer_state=None, layer=None):
 
+        self._pending = None
+        self._generation = 0
+
         x_min, x_max = viewer_state.x_min, viewer_state.x_max
         self.track_key = id(layer.data)
         self.track_axes = self._setup_track_axes(axes, self.track_key, viewer_state)
@@ -63,17 +79,57 @@ class GenomeTrackLayerArtist(MatplotlibLayerArtist):
             return
 
         changed = set() if force else self.pop_changed_properties()
-        if force or any(prop in changed for prop in ('chr', 'start', 'end', 'loop_count')):
+        if force or any(prop in changed for prop in ('chr', 'start', 'end', 'loop_count', 'stat')):
             self._update_plot_data(force=force)
 
         if force or any(prop in changed for prop in ('alpha', 'color', 'zorder', 'visible')):
             self._update_visual_attributes()
 
     def _update_plot_data(self, force=False):
-        # Prepare new data
+        key = self.state.viz_key
+        if self.dispatch is not None and not self.state.is_cached(key):
+            self._request(key)
+            return
+
+        self._supersede()
+        self._update_artists()
+        self._update_visual_attributes()
+
+    def _supersede(self):
+        """Cancel the pending fetch, if any, and ignore its result."""
+        self._generation += 1
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    def _request(self, key):
+        """Fetch the data for ``key`` in the background, superseding earlier requests."""
+        self._supersede()
+        future = self._pending = FETCH_POOL.submit(self.state.fetch, key)
+        receive = partial(self._receive, self._generation, key)
+        future.add_done_callback(lambda future: self.dispatch(partial(receive, future)))
+
+    def _receive(self, generation, key, future):
+        # Runs on the GUI thread; results of superseded requests are dropped
+        if generation != self._generation or future.cancelled():
+            return
+        self._pending = None
+        if key != self.state.viz_key:
+            self._request(self.state.viz_key)
+            return
+        try:
+            df = future.result()
+        except Exception:
+            logger.exception("Failed to fetch %s for %s", key, self.layer.label)
+            return
+        self.state.set_cache(key, df)
         self._update_artists()
         self._update_visual_attributes()
 
+    def remove(self):
+        self._supersede()
+        super().remove()
+
     @defer_draw
     def update(self):
         self.state.reset_cache()
@@ -90,26 +146,89 @@ class GenomeTrackLayerArtist(MatplotlibLayerArtist):
 
 class GenomeProfileLayerArtist(GenomeTrackLayerArtist):
 
+    # Intervals are collapsed into a min/max envelope once there are more
+    # than this many per horizontal pixel of the track
+    samples_per_pixel = 2
+
+    _verts = np.zeros((0, 2))
+
     @defer_draw
     def _update_artists(self):
         df: pd.DataFrame = self.state.viz_data
         if df.empty:
             return
 
-        x = np.vstack([df.start, df.start, df.stop, df.stop]).T.ravel()
-        y = np.vstack([df.value * 0, df.value, df.value, df.value * 0]).T.ravel()
+        x_min, x_max = sorted((self._viewer_state.x_min, self._viewer_state.x_max))
+        n_columns = int(self.samples_per_pixel * (self.track_axes.bbox.width or 1000))
+        if len(df) > n_columns and x_max > x_min:
+            verts = self._envelope_verts(df, x_min, x_max, n_columns)
+        else:
+            verts = self._step_verts(df)
 
         if not self.mpl_artists:
-            artist = self.track_axes.fill_between(x, y)
+            # The same closed outline as later updates, rather than a curve for fill_between
+            artist = PolyCollection([verts])
+            self.track_axes.add_collection(artist)
             self.mpl_artists.append(artist)
         else:
-            self.mpl_artists[-1].set_verts([np.column_stack([x, y])])
+            self.mpl_artists[-1].set_verts([verts])
 
         if isinstance(self.layer, Data):
-            self.track_axes.set_ylim(y.min(), y.max())
+            self.track_axes.set_ylim(verts[:, 1].min(), verts[:, 1].max())
 
         self.redraw()
 
+    def _buffer(self, n):
+        """A ``(n, 2)`` vertex array, viewing a buffer that only grows between redraws."""
+        if len(self._verts) < n:
+            # Grow geometrically, as the vertex count changes with most pans and zooms
+            self._verts = np.zeros((max(n, 2 * len(self._verts)), 2))
+        return self._verts[:n]
+
+    def _step_verts(self, df):
+        """Outline of the intervals as steps down to zero, four vertices per interval."""
+        verts = self._buffer(4 * len(df))
+        start, stop, value = df.start.to_numpy(), df.stop.to_numpy(), df.value.to_numpy()
+        verts[0::4, 0] = start
+        verts[1::4, 0] = start
+        verts[2::4, 0] = stop
+        verts[3::4, 0] = stop
+        verts[0::4, 1] = 0
+        verts[1::4, 1] = value
+        verts[2::4, 1] = value
+        verts[3::4, 1] = 0
+        return verts
+
+    def _envelope_verts(self, df, x_min, x_max, n_columns):
+        """
+        Outline of the min/max envelope of the intervals over ``n_columns``
+        equal columns between ``x_min`` and ``x_max``, zero included.
+        """
+        width = (x_max - x_min) / n_columns
+        first = np.clip(((df.start.to_numpy() - x_min) // width).astype(np.int64), 0, n_columns - 1)
+        last = np.clip(((df.stop.to_numpy() - x_min) // width).astype(np.int64), 0, n_columns - 1)
+        value = df.value.to_numpy()
+
+        # Spread each interval over every column it covers
+        counts = last - first + 1
+        rows = np.repeat(np.arange(len(df)), counts)
+        columns = first[rows] + np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        upper = np.zeros(n_columns)
+        lower = np.zeros(n_columns)
+        np.maximum.at(upper, columns, value[rows])
+        np.minimum.at(lower, columns, value[rows])
+
+        # Top edge left to right, then bottom edge right to left
+        edges = x_min + width * np.arange(n_columns + 1)
+        verts = self._buffer(4 * n_columns)
+        top, bottom = verts[:2 * n_columns], verts[2 * n_columns:]
+        top[0::2, 0], top[1::2, 0] = edges[:-1], edges[1:]
+        top[0::2, 1] = top[1::2, 1] = upper
+        bottom[0::2, 0], bottom[1::2, 0] = edges[:0:-1], edges[-2::-1]
+        bottom[0::2, 1] = bottom[1::2, 1] = lower[::-1]
+        return verts
+
     @defer_draw
     def _update_visual_attributes(self):
         super()._update_visual_attributes()
@@ -127,32 +246,37 @@ class GenomeProfileLayerArtist(GenomeTrackLayerArtist):
 
 class GenomeLoopLayerArtist(GenomeTrackLayerArtist):
 
+    # Points per arc, and the unit half circle they are scaled from
+    arc_resolution = 33
+    _unit_arc = np.exp(1j * np.linspace(0, np.pi, arc_resolution))
+
     @defer_draw
     def _update_artists(self):
-        for artist in self.mpl_artists:
-            artist.remove()
-        self.mpl_artists = []
-
         df: pd.DataFrame = self.state.viz_data
+
+        if not self.mpl_artists:
+            artist = LineCollection([], alpha=0.3)
+            self.track_axes.add_collection(artist)
+            self.mpl_artists.append(artist)
+        artist = self.mpl_artists[-1]
+
         if df.empty:
+            artist.set_segments([])
+            self.redraw()
             return
 
-        df['diameter'] = (df.start2 + df.end2) / 2. - (df.start1 + df.end1) / 2.
-
-        for _, rec in df.iterrows():
-            center = (rec.start1 + rec.end1 + rec.start2 + rec.end2) / 4.
-            height = rec.diameter
-            width = np.sqrt(min(rec.value, 10)) / 2.
-            arc = Arc(
-                (center, 0), rec.diameter,
-                height, 0, 0, 180, lw=width, alpha=0.3
-            )
+        start1, end1 = df.start1.to_numpy(), df.end1.to_numpy()
+        start2, end2 = df.start2.to_numpy(), df.end2.to_numpy()
+        diameter = (start2 + end2) / 2. - (start1 + end1) / 2.
+        center = (start1 + end1 + start2 + end2) / 4.
 
-            self.track_axes.add_patch(arc)
-            self.mpl_artists.append(arc)
+        # One half circle per loop, as an (n_loops, arc_resolution, 2) array
+        arcs = center[:, None] + diameter[:, None] / 2. * self._unit_arc
+        artist.set_segments(np.stack([arcs.real, arcs.imag], axis=-1))
+        artist.set_linewidths(np.sqrt(np.minimum(df.value.to_numpy(), 10)) / 2.)
 
         if isinstance(self.layer, Data):
-            self.track_axes.set_ylim(0, df.diameter.max() / 2)
+            self.track_axes.set_ylim(0, diameter.max() / 2)
 
         self.redraw()
 
@@ -167,7 +291,6 @@ class GenomeLoopLayerArtist(GenomeTrackLayerArtist):
             mpl_artist.set_visible(self.state.visible)
             mpl_artist.set_zorder(self.state.zorder)
             mpl_artist.set_alpha(self.state.alpha)
-            mpl_artist.set_facecolor(self.state.color)
             mpl_artist.set_edgecolor(self.state.color)
 
         self.redraw()
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+
+from glue.core import Subset
+
+from ..data import GenomicData
+
+__all__ = ['Prefetcher']
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Warm the query caches of the tracks of a `GenomeTrackState` ahead of the user.
+
+    The prefetcher watches the ``chr``, ``start`` and ``end`` callbacks of the
+    viewer state and keeps moving averages of the pan direction and of the
+    zoom trend. After each view change it queries, in the background, the
+    windows the user is likely to look at next:
+
+    * the window one view width further along the pan direction (or both
+      flanking windows while the direction is unclear), and
+    * if zooming in or out, the same center at the next finer or coarser
+      decimation level, i.e. a span ``downsample_factor`` times smaller or
+      larger.
+
+    Results are discarded: the point is to fill the engines' tile caches
+    (see `glue_genomics_viewers.cache`), so tracks without a tile cache are
+    skipped.
+
+    Parameters
+    ----------
+    viewer_state: The `GenomeTrackState` to follow
+    concurrency: Number of worker threads issuing prefetch queries
+    memory_budget: Approximate number of bytes that may be prefetched after
+        each view change; further predictions are skipped.
+    """
+
+    # Weight of the latest move in the moving averages
+    smoothing = 0.5
+
+    def __init__(self, viewer_state, concurrency=2, memory_budget=64 * 2 ** 20):
+        self.viewer_state = viewer_state
+        self.memory_budget = memory_budget
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='genome-track-prefetch')
+        self._futures = []
+        self._view = None
+        self._pan = 0.
+        self._zoom = 0.
+        self._fetched = 0
+
+        for prop in ('chr', 'start', 'end'):
+            viewer_state.add_callback(prop, self._on_view_change)
+
+    def _on_view_change(self, *args):
+        state = self.viewer_state
+        if state.chr is None or state.start is None or state.end is None:
+            return
+        view = state.chr, int(max(state.start, 0)), int(max(state.end, 0))
+        if view == self._view or view[2] <= view[1]:
+            return
+
+        previous, self._view = self._view, view
+        if previous is not None and previous[0] == view[0]:
+            self._learn(previous, view)
+        else:
+            self._pan = self._zoom = 0.
+
+        for future in self._futures:
+            future.cancel()
+        self._fetched = 0
+        self._futures = [self._pool.submit(self._prefetch, data, view[0], start, end)
+                         for start, end in self.predict(view)
+                         for data in self._datasets()]
+
+    def _learn(self, previous, view):
+        _, start0, end0 = previous
+        _, start, end = view
+        span0, span = end0 - start0, end - start
+        zoom = math.log(span / span0)
+        shift = ((start + end) - (start0 + end0)) / 2
+        # A move that mostly changes the span is a zoom, not a pan
+        pan = 0. if abs(zoom) > 0.05 else math.copysign(1., shift) if shift else 0.
+        a = self.smoothing
+        self._pan = a * pan + (1 - a) * self._pan
+        self._zoom = a * zoom + (1 - a) * self._zoom
+
+    def predict(self, view):
+        """Return the ``(start, end)`` windows to prefetch after moving to ``view``."""
+        _, start, end = view
+        span = end - start
+        center = (start + end) / 2
+
+        if self._pan > 0.3:
+            directions = [1]
+        elif self._pan < -0.3:
+            directions = [-1]
+        else:
+            directions = [1, -1]
+        windows = [(start + d * span, end + d * span) for d in directions]
+
+        factor = self._downsample_factor()
+        if self._zoom < -0.05:
+            windows.append((center - span / factor / 2, center + span / factor / 2))
+        elif self._zoom > 0.05:
+            windows.append((center - span * factor / 2, center + span * factor / 2))
+
+        return [(int(max(s, 0)), int(e)) for s, e in windows if e > 0]
+
+    def _downsample_factor(self):
+        return max((data.engine.downsample_factor for data in self._datasets()), default=10)
+
+    def _datasets(self):
+        """The distinct datasets shown in the viewer whose engines have a tile cache."""
+        result = []
+        for layer_state in self.viewer_state.layers:
+            layer = layer_state.layer
+            data = layer.data if isinstance(layer, Subset) else layer
+            if (isinstance(data, GenomicData) and all(data is not other for other in result) and
+                    getattr(data.engine, 'tile_cache', None) is not None):
+                result.append(data)
+        return result
+
+    def _prefetch(self, data, chr, start, end):
+        if self._fetched >= self.memory_budget:
+            return
+        try:
+            df = data.profile(chr, start, end, target=self.viewer_state.loop_count, stat=None)
+        except Exception:
+            logger.debug("Prefetching %s:%s-%s of %s failed", chr, start, end, data.label, exc_info=True)
+            return
+        self._fetched += int(df.memory_usage(index=True).sum())
+
+    def stop(self):
+        """Cancel pending prefetches and stop following the viewer state."""
+        for prop in ('chr', 'start', 'end'):
+            self.viewer_state.remove_callback(prop, self._on_view_change)
+        for future in self._futures:
+            future.cancel()
+        self._pool.shutdown(wait=False)
@@ -6,9 +6,11 @@ from glue.viewers.matplotlib.qt.data_viewer import MatplotlibDataViewer
 from ...data import BedgraphData
 from ...subsets import GenomicRangeSubsetState
 
+from .dispatch import MainThreadDispatcher
 from .layer_style_editor import GenomeTrackLayerStyleEditor
 from .options_widget import GenomeTrackOptionsWidget
 from ..layer_artist import GenomeProfileLayerArtist, GenomeLoopLayerArtist
+from ..prefetch import Prefetcher
 from ..state import GenomeTrackState
 
 __all__ = ['GenomeTrackViewer']
@@ -25,15 +27,33 @@ class GenomeTrackViewer(MatplotlibDataViewer):
 
     large_data_size = 2e7
 
+    # Background prefetching of the windows likely to be viewed next (see `Prefetcher`)
+    prefetch = True
+    prefetch_concurrency = 2
+    prefetch_memory_budget = 64 * 2 ** 20
+
     tools = ['select:xrange']
 
     def __init__(self, session, parent=None, state=None):
         super().__init__(session, parent=parent, state=state)
         self._layer_artist_container.on_changed(self.reflow_tracks)
+        # Layer artists fetch their data in worker threads and redraw through this
+        self._dispatcher = MainThreadDispatcher(self)
+        self._prefetcher = None
+        if self.prefetch:
+            self._prefetcher = Prefetcher(self.state, concurrency=self.prefetch_concurrency,
+                                          memory_budget=self.prefetch_memory_budget)
+
+    def cleanup(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        super().cleanup()
 
     def get_data_layer_artist(self, layer=None, layer_state=None):
         cls = GenomeProfileLayerArtist if isinstance(layer, BedgraphData) else GenomeLoopLayerArtist
         result = self.get_layer_artist(cls, layer=layer, layer_state=layer_state)
+        result.dispatch = self._dispatcher.dispatch
         result.state.add_callback('zorder', self.reflow_tracks)
         result.state.add_callback('visible', self.reflow_tracks)
         return result
@@ -42,6 +62,7 @@ class GenomeTrackViewer(MatplotlibDataViewer):
         data = layer.data if layer else None
         cls = GenomeProfileLayerArtist if isinstance(data, BedgraphData) else GenomeLoopLayerArtist
         result = self.get_layer_artist(cls, layer=layer, layer_state=layer_state)
+        result.dispatch = self._dispatcher.dispatch
         result.state.add_callback('zorder', self.reflow_tracks)
         result.state.add_callback('visible', self.reflow_tracks)
         return result
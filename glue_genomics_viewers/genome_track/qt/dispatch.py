@@ -0,0 +1,25 @@
+from qtpy import QtCore
+
+__all__ = ['MainThreadDispatcher']
+
+
+class MainThreadDispatcher(QtCore.QObject):
+    """
+    Run callables on the Qt main thread.
+
+    `dispatch` may be called from any thread; the callable is delivered
+    through a queued signal and runs in the event loop of the thread this
+    object lives in, which must be the GUI thread.
+    """
+
+    _call = QtCore.Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._call.connect(self._run, QtCore.Qt.QueuedConnection)
+
+    def _run(self, func):
+        func()
+
+    def dispatch(self, func):
+        self._call.emit(func)
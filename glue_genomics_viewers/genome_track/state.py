@@ -9,8 +9,8 @@ from glue.viewers.matplotlib.state import (MatplotlibDataViewerState,
 from glue.utils.decorators import avoid_circular
 from glue.utils import defer_draw, decorate_all_methods
 
-from ..data import BedPeData
-from ..subsets import GenomicRangeSubsetState
+from ..data import BedGraph, BedgraphData, BedPeData
+from ..subsets import GenomicRangeSubsetState, GenomicMulitRangeSubsetState, genomic_ranges
 
 __all__ = ['GenomeTrackState']
 
@@ -55,6 +55,8 @@ class GenomeTrackState(MatplotlibDataViewerState):
 
 class GenomeTrackLayerState(MatplotlibLayerState):
 
+    stat = DDCProperty('max', docstring='Summary statistic shown by profile tracks, one of BedGraph.stats')
+
     _cache = None, None
 
     def reset_cache(self, *args):
@@ -68,11 +70,31 @@ class GenomeTrackLayerState(MatplotlibLayerState):
     def viewer_state(self, viewer_state: GenomeTrackState):
         self._viewer_state = viewer_state
 
+    @property
+    def viz_key(self):
+        """The ``(chr, start, end, loop_count)`` key of the data currently in view."""
+        return self.viewer_state.chr, int(max(self.viewer_state.start, 0)), int(max(self.viewer_state.end, 0)), self.viewer_state.loop_count
+
+    def is_cached(self, key):
+        return key == self._cache[0]
+
+    def set_cache(self, key, df):
+        """Store the result of `fetch` for ``key``, e.g. once a background fetch completes."""
+        self._cache = key, df
+
     @property
     def viz_data(self) -> pd.DataFrame:
-        key = self.viewer_state.chr, int(max(self.viewer_state.start, 0)), int(max(self.viewer_state.end, 0)), self.viewer_state.loop_count
-        if key == self._cache[0]:
-            return self._cache[1]
+        key = self.viz_key
+        if key != self._cache[0]:
+            self._cache = key, self.fetch(key)
+        return self._with_stat(self._cache[1])
+
+    def fetch(self, key) -> pd.DataFrame:
+        """
+        Query the data for ``key`` (see `viz_key`), without touching the cache.
+
+        This does not depend on the viewer state, and may run in a worker thread.
+        """
         chr, start, end, loop_count = key
 
         
@@ -85,6 +107,13 @@ class GenomeTrackLayerState(MatplotlibLayerState):
                     subset_state = self.layer.subset_state.to_genome_range()
                 except AttributeError:
                     pass
+            if not isinstance(subset_state, (GenomicRangeSubsetState, GenomicMulitRangeSubsetState)):
+                # Evaluate linked selections on any genomic table of the data collection
+                group = getattr(self.layer, 'group', None)
+                if group is not None:
+                    ranges = genomic_ranges(subset_state, [subset.data for subset in group.subsets])
+                    if ranges is not None:
+                        subset_state = ranges
             #else:
                 
         else:
@@ -94,7 +123,12 @@ class GenomeTrackLayerState(MatplotlibLayerState):
         if isinstance(data, BedPeData):
             df = data.profile(chr, start, end, target=loop_count, subset_state=subset_state)
         else:
-            df = data.profile(chr, start, end, subset_state=subset_state)
-
-        self._cache = key, df
+            # Cache every statistic, so that changing `stat` does not re-query
+            df = data.profile(chr, start, end, subset_state=subset_state, stat=None)
         return df
+
+    def _with_stat(self, df):
+        data = self.layer.data if isinstance(self.layer, Subset) else self.layer
+        if not isinstance(data, BedgraphData) or df.empty:
+            return df
+        return df.assign(value=BedGraph.statistic(df, self.stat))
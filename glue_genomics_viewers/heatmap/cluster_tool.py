@@ -1,6 +1,9 @@
+import logging
+
+from qtpy import QtCore
+
 from glue.config import viewer_tool
 from glue.viewers.common.tool import Tool
-import seaborn as sns
 import pandas as pd
 import scipy.cluster.hierarchy as hierarchy 
 
@@ -16,6 +19,10 @@ import numpy as np
 import ete3
 import skbio
 
+from .clustering import ClusteringCancelled, ClusteringJob
+
+logger = logging.getLogger(__name__)
+
 
 
 def getNewick(node, newick, parentdist, leaf_names):
@@ -112,43 +119,86 @@ class ClusterTool(Tool):
     tool_tip = 'Apply hierarchical clustering to matrix'
     shortcut = 'Ctrl+K'
 
+    # Interval, in milliseconds, at which a running clustering is polled
+    poll_interval = 200
+
     def __init__(self, viewer):
         super(ClusterTool, self).__init__(viewer)
-
-
-
+        self._job = None
+        self._data = None
+        self._timer = QtCore.QTimer()
+        self._timer.setInterval(self.poll_interval)
+        self._timer.timeout.connect(self._poll)
 
     def activate(self):
         """
-        We use seaborn.clustermap to cluster the data and then
-        use the indices returned from this method to update the data components and
-        update the Coords for the data object
-        
-        TODO: could/should also spawn a dendrogram showing connectedness
+        Start clustering the reference data in the background, or cancel the
+        clustering if one is already running.
+
+        The linkages are computed by a `ClusteringJob`, polled from the Qt
+        event loop, which reports progress in the status bar and reorders
+        the data once the job finishes (see `_apply`).
         """
-        data = self.viewer.state.reference_data    
-        
-        g = sns.clustermap(data['counts']) #This should not be hard coded... I guess it should come from state
-        new_row_ind = g.dendrogram_row.reordered_ind
-        new_col_ind = g.dendrogram_col.reordered_ind
+        if self._job is not None:
+            self._job.cancel()
+            self._show_message('Cancelling clustering...')
+            return
+
+        self._data = self.viewer.state.reference_data
+        self._job = ClusteringJob(self._data['counts']) #This should not be hard coded... I guess it should come from state
+        self._show_message('Clustering...')
+        self._timer.start()
+
+    def _poll(self):
+        job = self._job
+        if not job.done():
+            if not job.cancelled:
+                self._show_message('Clustering %s: %i%%' % (job.stage, 100 * job.progress))
+            return
+
+        self._timer.stop()
+        self._job = None
+        try:
+            result = job.result()
+        except ClusteringCancelled:
+            self._show_message('Clustering cancelled', 3000)
+            return
+        except Exception:
+            logger.exception("Clustering %s failed", self._data.label)
+            self._show_message('Clustering failed', 3000)
+            return
+
+        self._apply(self._data, result)
+        self._show_message('Clustering done', 3000)
+
+    def _show_message(self, message, timeout=0):
+        status_bar = getattr(self.viewer, 'statusBar', None)
+        if status_bar is not None:
+            status_bar().showMessage(message, timeout)
+
+    def _apply(self, data, result):
+        """
+        Use the leaf orders of the `ClusteringResult` to update the data
+        components and the Coords for the data object, and show the
+        dendrograms.
+        """
+        new_row_ind = result.row_order
+        new_col_ind = result.col_order
         
         orig_xticks = data.coords.x_axis_ticks
         orig_yticks = data.coords.y_axis_ticks
         orig_labels = data.coords._labels
 
-        new_xticks = [orig_xticks[i] for i in new_col_ind]
-        new_yticks = [orig_yticks[i] for i in new_row_ind]
-
-        data.coords.x_axis_ticks = np.array(new_xticks)
-        data.coords.y_axis_ticks = np.array(new_yticks)
+        data.coords.x_axis_ticks = orig_xticks[new_col_ind]
+        data.coords.y_axis_ticks = orig_yticks[new_row_ind]
         
         for component in data.components:
             if not isinstance(component, PixelComponentID):  # Ignore pixel components
                 data.update_components({component:pd.DataFrame(data.get_data(component)).iloc[new_row_ind,new_col_ind]})
         
         #print(g.dendrogram_col.linkage)
-        column_dendrogram = g.dendrogram_col.linkage
-        row_dendrogram = g.dendrogram_row.linkage
+        column_dendrogram = result.col_linkage
+        row_dendrogram = result.row_linkage
         #yo[:,2] = yo[:,2]/np.max(yo[:,2]) #Normalize by max
         #print(yo)
         
@@ -205,7 +255,12 @@ class ClusterTool(Tool):
 
     def close(self):
         """
+        Cancel a running clustering.
+
         If we wanted to make clustering not permanently change the dataset we could
         cache the original data and then restore it on close.
         """
-        pass
+        if self._job is not None:
+            self._job.cancel()
+            self._timer.stop()
+            self._job = None
@@ -0,0 +1,104 @@
+"""
+Hierarchical clustering of heatmap matrices in the background.
+
+`ClusteringJob` computes the row and column linkages of a matrix with SciPy
+in a worker thread, without drawing anything, so that the `ClusterTool` can
+keep the interface responsive, report progress and be cancelled while large
+matrices are clustered.
+"""
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from dataclasses import dataclass
+import threading
+
+import numpy as np
+from scipy.cluster import hierarchy
+
+__all__ = ['ClusteringJob', 'ClusteringResult', 'ClusteringCancelled']
+
+# Clusterings are memory hungry, so run them one at a time
+CLUSTER_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='heatmap-cluster')
+
+
+class ClusteringCancelled(Exception):
+    """Raised by `ClusteringJob.result` for a cancelled job."""
+
+
+@dataclass
+class ClusteringResult:
+    """Linkage matrices of the rows and columns, and the resulting leaf orders."""
+    row_linkage: np.ndarray
+    col_linkage: np.ndarray
+    row_order: np.ndarray
+    col_order: np.ndarray
+
+
+class ClusteringJob:
+    """
+    Cluster the rows and columns of ``matrix`` in a worker thread.
+
+    The defaults match those of ``seaborn.clustermap``: average linkage of
+    euclidean distances, with leaves in dendrogram order.
+
+    `progress` goes from 0 to 1 as the linkages complete, weighted by their
+    quadratic cost, and `stage` names the linkage being computed. A single
+    linkage cannot be interrupted, so `cancel` takes effect once the current
+    one completes, and its result is discarded.
+
+    Parameters
+    ----------
+    matrix: 2D array to cluster
+    method: Linkage method, see `scipy.cluster.hierarchy.linkage`
+    metric: Distance metric, see `scipy.spatial.distance.pdist`
+    """
+
+    def __init__(self, matrix, method='average', metric='euclidean'):
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.method = method
+        self.metric = metric
+        self.progress = 0.
+        self.stage = 'queued'
+        self._cancelled = threading.Event()
+        self._future = CLUSTER_POOL.submit(self._run)
+
+    def _run(self):
+        n_rows, n_cols = self.matrix.shape
+        # Computing the distances and linkage of n observations costs O(n^2)
+        costs = {'rows': n_rows ** 2, 'columns': n_cols ** 2}
+        total = sum(costs.values())
+        linkages = {}
+        for stage, observations in (('rows', self.matrix), ('columns', self.matrix.T)):
+            if self._cancelled.is_set():
+                raise ClusteringCancelled()
+            self.stage = stage
+            linkages[stage] = hierarchy.linkage(observations, method=self.method, metric=self.metric)
+            self.progress += costs[stage] / total
+        if self._cancelled.is_set():
+            raise ClusteringCancelled()
+        self.stage = 'done'
+        return ClusteringResult(row_linkage=linkages['rows'], col_linkage=linkages['columns'],
+                                row_order=hierarchy.leaves_list(linkages['rows']),
+                                col_order=hierarchy.leaves_list(linkages['columns']))
+
+    def cancel(self):
+        self._cancelled.set()
+        self._future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        """Whether the job finished, failed or was cancelled."""
+        return self._future.done()
+
+    def result(self, timeout=None):
+        """
+        Return the `ClusteringResult`, waiting up to ``timeout`` seconds.
+
+        Raises `ClusteringCancelled` if the job was cancelled, or the
+        exception raised by the clustering.
+        """
+        try:
+            return self._future.result(timeout)
+        except CancelledError:
+            raise ClusteringCancelled()
@@ -3,17 +3,50 @@ import numpy as np
 
 class HeatmapCoords(IdentityCoordinates):
 
-	def __init__(self, n_dim=2, x_axis_ticks=[], y_axis_ticks=[], labels=[]):
+	def __init__(self, n_dim=2, x_axis_ticks=[], y_axis_ticks=[], labels=[], x_axis_attribute=None, y_axis_attribute=None):
 		super().__init__(n_dim=n_dim)
+
+		# Per axis, the ticks in pixel order
+		self._ticks = {}
 		
 		self.x_axis_ticks = x_axis_ticks
 		self.y_axis_ticks = y_axis_ticks
+
+		# Labels of the components holding the x/y tick of every element, if known.
+		# HeatmapViewerState uses these instead of scanning the data for them.
+		self.x_axis_attribute = x_axis_attribute
+		self.y_axis_attribute = y_axis_attribute
 		
 		#self.np_x_axis_ticks = np.array(x_axis_ticks) #Can we just use this?
 		#self.np_y_axis_ticks = np.array(y_axis_ticks)
 
 		self._labels = labels
 		
+	@property
+	def x_axis_ticks(self):
+		return self._ticks['x']
+
+	@x_axis_ticks.setter
+	def x_axis_ticks(self, ticks):
+		self._set_ticks('x', ticks)
+
+	@property
+	def y_axis_ticks(self):
+		return self._ticks['y']
+
+	@y_axis_ticks.setter
+	def y_axis_ticks(self, ticks):
+		self._set_ticks('y', ticks)
+
+	def _set_ticks(self, axis, ticks):
+		self._ticks[axis] = np.asarray(ticks)
+
+	def pixel_to_tick(self, axis, pixels):
+		"""
+		Return the ticks at the integer ``pixels`` along ``axis`` (``'x'`` or ``'y'``).
+		"""
+		return self._ticks[axis][np.asarray(pixels, dtype=int)]
+
 	def get_tick_labels(self, axis_name):
 		if (axis_name == 'Pixel Axis 1 [x]') or (axis_name == 'World 1') or (axis_name == 'Experiment Id'):
 			return self.x_axis_ticks
@@ -21,7 +21,8 @@ from glue.core.message import (ComponentsChangedMessage,
 from glue.viewers.image.frb_artist import imshow
 from glue.core.fixed_resolution_buffer import ARRAY_CACHE, PIXEL_CACHE
 
-from .state import HeatmapLayerState, HeatmapSubsetLayerState
+from .pyramid import discard_pyramids
+from .state import HeatmapLayerState, HeatmapSubsetLayerState, discard_subset_masks
 
 
 class HeatmapHeatmapLayerArtist(MatplotlibLayerArtist, HubListener):
@@ -183,7 +184,7 @@ class HeatmapLayerArtist(HeatmapHeatmapLayerArtist):
 
         changed = set() if force else self.pop_changed_properties()
 
-        if force or any(prop in changed for prop in ('layer', 'attribute',
+        if force or any(prop in changed for prop in ('layer', 'attribute', 'lod',
                                                      'slices', 'x_att', 'y_att')):
             self._update_image_data()
             force = True  # make sure scaling and visual attributes are updated
@@ -198,6 +199,7 @@ class HeatmapLayerArtist(HeatmapHeatmapLayerArtist):
     def update(self, *event):
         ARRAY_CACHE.pop(self.state.uuid, None)
         PIXEL_CACHE.pop(self.state.uuid, None)
+        discard_pyramids(self.layer)
         self._update_image(force=True)
         self.redraw()
 
@@ -208,6 +210,7 @@ class HetampSubsetArray(object):
         self._viewer_state = weakref.ref(viewer_state)
         self._layer_artist = weakref.ref(layer_artist)
         self._layer_state = weakref.ref(layer_artist.state)
+        self._rgba = None
 
     @property
     def layer_artist(self):
@@ -250,11 +253,14 @@ class HetampSubsetArray(object):
         else:
             self.layer_artist.enable(redraw=False)
 
+        # Colorize into a buffer reused across draws; the image makes its own copy
+        if self._rgba is None or self._rgba.shape[:2] != mask.shape:
+            self._rgba = np.empty(mask.shape + (4,), dtype=np.uint8)
         r, g, b = color2rgb(self.layer_state.color)
-        mask = np.dstack((r * mask, g * mask, b * mask, mask * .5))
-        mask = (255 * mask).astype(np.uint8)
+        # Masks of aggregated slices are fractional: scale color and alpha by them
+        np.multiply(mask[..., np.newaxis], 255 * np.array([r, g, b, .5]), out=self._rgba, casting='unsafe')
 
-        return mask
+        return self._rgba
 
     @property
     def dtype(self):
@@ -369,5 +375,7 @@ class HeatampSubsetLayerArtist(HeatmapHeatmapLayerArtist):
     def update(self, *event):
         ARRAY_CACHE.pop(self.state.uuid, None)
         PIXEL_CACHE.pop(self.state.uuid, None)
+        # Called when the subset or the values of its data change, but not for style changes
+        discard_subset_masks(self.state.layer.subset_state)
         self._update_image(force=True)
         self.redraw()
@@ -0,0 +1,131 @@
+"""
+Multi-resolution pyramids of heatmap layers.
+
+When zoomed out so far that several matrix elements fall in each screen
+pixel, `HeatmapLayerState.get_sliced_data` reads from a reduced copy of the
+matrix instead of resampling the full array. Level ``L`` of a pyramid
+reduces the matrix over blocks of ``2 ** L`` by ``2 ** L`` elements, with the
+mean or the maximum, so that zoomed out views summarize every element rather
+than showing whichever one the nearest-neighbor sampling lands on.
+
+Levels are built on first use, each from the previous one, and pyramids are
+cached per ``(data, attribute, reduction)`` until `discard_pyramids` is
+called for the data, e.g. when its values change.
+"""
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+__all__ = ['HeatmapPyramid', 'get_pyramid', 'discard_pyramids']
+
+# Per dataset, its pyramids keyed by (attribute, reduction)
+_PYRAMIDS = WeakKeyDictionary()
+
+
+def get_pyramid(data, attribute, reduction='mean'):
+    """Return the cached pyramid of ``attribute`` of ``data``, creating it if needed."""
+    pyramids = _PYRAMIDS.setdefault(data, {})
+    key = attribute, reduction
+    if key not in pyramids:
+        pyramids[key] = HeatmapPyramid(data.get_data(attribute), reduction)
+    return pyramids[key]
+
+
+def discard_pyramids(data):
+    """Drop the pyramids of ``data``, e.g. after its values changed."""
+    _PYRAMIDS.pop(data, None)
+
+
+def _block_sum(values):
+    h, w = values.shape
+    return values.reshape(h // 2, 2, w // 2, 2).sum(axis=(1, 3))
+
+
+def _pad_even(values, fill):
+    pad = [(0, n % 2) for n in values.shape]
+    return np.pad(values, pad, constant_values=fill) if any(p for _, p in pad) else values
+
+
+class HeatmapPyramid:
+    """
+    Reductions of a 2D array over blocks of 2x2, 4x4, ... elements.
+
+    NaN elements are ignored by both reductions. For the mean, every level
+    keeps the number of finite elements per block, so that blocks at the
+    edges and blocks with missing values are weighted correctly.
+
+    Parameters
+    ----------
+    array: The 2D array at full resolution, used as level 0
+    reduction: ``'mean'`` or ``'max'``
+    """
+
+    reductions = ('mean', 'max')
+
+    def __init__(self, array, reduction='mean'):
+        if reduction not in self.reductions:
+            raise ValueError("reduction should be one of %s, not %r" % (self.reductions, reduction))
+        self.reduction = reduction
+        self.shape = array.shape
+        # (values, finite element counts) per level; counts are only kept for the mean
+        self._levels = [(array, None)]
+
+    @property
+    def max_level(self):
+        """The level at which the whole array is reduced to a single element."""
+        return int(np.ceil(np.log2(max(max(self.shape), 1))))
+
+    def level(self, level):
+        """Return the values of ``level``, building it and the levels below if needed."""
+        while len(self._levels) <= level:
+            self._levels.append(self._reduce(*self._levels[-1]))
+        return self._levels[level][0]
+
+    def _reduce(self, values, counts):
+        values = np.asarray(values, dtype=float)
+        if self.reduction == 'max':
+            values = _pad_even(values, np.nan)
+            h, w = values.shape
+            return np.fmax.reduce(values.reshape(h // 2, 2, w // 2, 2), axis=(1, 3)), None
+
+        if counts is None:
+            counts = np.isfinite(values).astype(np.int64)
+        sums = _block_sum(_pad_even(np.where(counts > 0, values, 0.) * counts, 0.))
+        counts = _block_sum(_pad_even(counts, 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts, counts
+
+    def choose_level(self, bounds):
+        """
+        Return the coarsest level whose elements are no larger than the
+        spacing of the samples given by ``bounds``, see `sample`.
+        """
+        spacing = min((stop - start) / (n - 1) if n > 1 else np.inf for start, stop, n in bounds)
+        if spacing < 2:
+            return 0
+        return min(int(np.log2(spacing)), self.max_level)
+
+    def sample(self, bounds, level=None):
+        """
+        Sample the pyramid on a regular grid.
+
+        ``bounds`` gives, for each of the two axes, the ``(start, stop, n)``
+        pixel coordinates of ``n`` evenly spaced samples, as for
+        `Data.compute_fixed_resolution_buffer`. Samples outside the array are
+        NaN. ``level`` defaults to `choose_level`.
+        """
+        if level is None:
+            level = self.choose_level(bounds)
+        values = self.level(level)
+        block = 2 ** level
+
+        indices, valid = [], []
+        for (start, stop, n), size, reduced_size in zip(bounds, self.shape, values.shape):
+            pixels = np.floor(np.linspace(start, stop, n) + 0.5)
+            valid.append((pixels >= 0) & (pixels < size))
+            indices.append(np.clip(pixels // block, 0, reduced_size - 1).astype(int))
+
+        image = np.asarray(values[np.ix_(*indices)], dtype=float)
+        image[~valid[0], :] = np.nan
+        image[:, ~valid[1]] = np.nan
+        return image
@@ -1,5 +1,6 @@
 import uuid
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from weakref import WeakKeyDictionary
 
 from glue.core import BaseData
 from glue.config import colormaps
@@ -11,15 +12,36 @@ from glue.core.state_objects import StateAttributeLimitsHelper
 from glue.utils import defer_draw, view_shape
 from echo import delay_callback
 from glue.core.data_combo_helper import ManualDataComboHelper, ComponentIDComboHelper
-from glue.core.exceptions import IncompatibleDataException
+from glue.core.exceptions import IncompatibleAttribute, IncompatibleDataException
 from glue.core.component_id import ComponentID, PixelComponentID
 from glue.core.component import CoordinateComponent
 
 import numpy as np
 
+from .pyramid import get_pyramid
 
 __all__ = ['HeatmapVewerState', 'HeatmapLayerState', 'HeatmapSubsetLayerState', 'AggregateSlice']
 
+# Per dataset, its components and the axis attributes found for them
+_AXIS_ATTRIBUTES = WeakKeyDictionary()
+
+# Per subset state, the masks computed for it by HeatmapSubsetLayerState.get_sliced_data
+_SUBSET_MASKS = WeakKeyDictionary()
+
+
+def discard_subset_masks(subset_state):
+    """Drop the cached masks of ``subset_state``, e.g. after the values of its data changed."""
+    _SUBSET_MASKS.pop(subset_state, None)
+
+
+def _freeze(value):
+    # A hashable version of (nested lists of) slices, bounds and indices
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, slice):
+        return value.start, value.stop, value.step
+    return value
+
 
 class HeatmapViewerState(MatplotlibDataViewerState):
     """
@@ -383,21 +405,48 @@ class HeatmapViewerState(MatplotlibDataViewerState):
 
     def _check_for_axis_attribute(self, axis_num=0):
         """
-        We want to find which data components are actually the categorical data encoding the x/y axis ticks
-        
-        https://stackoverflow.com/questions/14859458/how-to-check-if-all-values-in-the-columns-of-a-numpy-matrix-are-the-same
+        Find the component of the reference data encoding the x (``axis_num=0``)
+        or y (``axis_num=1``) axis ticks, i.e. one that is constant along the
+        other axis.
+
+        Results are cached per dataset until its components change, so that
+        switching layers does not rescan the matrix.
         """
-        for component in self.reference_data.components: #Need to avoid Pixel and other World components
-            #print(type(component))
-            #print(component)
-            if (component not in self.reference_data.world_component_ids) and (component not in self.reference_data.pixel_component_ids):
-                comp_data = self.reference_data.get_component(component).data
-                #print(comp_data.shape)
-                if axis_num == 1:
-                    comp_data = comp_data.T #Dumb, but it works
-                if np.all(np.all(comp_data == comp_data[0,:], axis = 0)):
-                    return component #Short circuit to just find the first one
+        data = self.reference_data
+        components = tuple(data.components)
+        cached = _AXIS_ATTRIBUTES.get(data)
+        if cached is None or cached[0] != components:
+            cached = components, {}
+            _AXIS_ATTRIBUTES[data] = cached
+        if axis_num not in cached[1]:
+            cached[1][axis_num] = self._find_axis_attribute(data, axis_num)
+        return cached[1][axis_num]
+
+    # Number of rows (or columns) compared with the first one by _find_axis_attribute
+    axis_sample_size = 32
+
+    def _find_axis_attribute(self, data, axis_num):
+        # Explicit metadata, see HeatmapCoords
+        label = getattr(data.coords, ('x_axis_attribute', 'y_axis_attribute')[axis_num], None)
+        if label is not None:
+            try:
+                return data.id[label]
+            except KeyError:
+                pass
 
+        for component in data.components: #Need to avoid Pixel and other World components
+            if (component in data.world_component_ids) or (component in data.pixel_component_ids):
+                continue
+            values = data.get_component(component).data
+            if values.ndim != 2:
+                continue
+            if axis_num == 1:
+                values = values.T
+            # Compare evenly spaced rows, always including the last, stopping at the first mismatch
+            n = values.shape[0]
+            rows = np.unique(np.linspace(0, n - 1, min(n, self.axis_sample_size)).astype(int))
+            if all(np.array_equal(values[i], values[0]) for i in rows[1:]):
+                return component #Short circuit to just find the first one
 
     def _set_default_slices(self):
         # Need to make sure this gets called immediately when reference_data is changed
@@ -538,12 +587,15 @@ class BaseHeatmapLayerState(MatplotlibLayerState):
             if isinstance(full_view[i], slice):
                 full_view[i] = slice_to_bound(full_view[i], self.viewer_state.reference_data.shape[i])
 
-        # We now get the fixed resolution buffer
+        # When zoomed out, read from a reduced level of the layer's pyramid,
+        # otherwise we get the fixed resolution buffer
+
+        image = self._get_lod_image(full_view)
 
-        if isinstance(self.layer, BaseData):
+        if image is None and isinstance(self.layer, BaseData):
             image = self.layer.compute_fixed_resolution_buffer(full_view, target_data=self.viewer_state.reference_data,
                                                                target_cid=self.attribute, broadcast=False, cache_id=self.uuid)
-        else:
+        elif image is None:
             image = self.layer.data.compute_fixed_resolution_buffer(full_view, target_data=self.viewer_state.reference_data,
                                                                     subset_state=self.layer.subset_state, broadcast=False, cache_id=self.uuid)
 
@@ -572,6 +624,10 @@ class BaseHeatmapLayerState(MatplotlibLayerState):
 
         return image
 
+    def _get_lod_image(self, full_view):
+        """Return the image sampled from a pyramid level, or `None` to use the full resolution data."""
+        return None
+
 
 class HeatmapLayerState(BaseHeatmapLayerState):
     """
@@ -593,6 +649,9 @@ class HeatmapLayerState(BaseHeatmapLayerState):
     global_sync = DDCProperty(False, docstring='Whether the color and transparency '
                                                'should be synced with the global '
                                                'color and transparency for the data')
+    lod = DDSCProperty(docstring='How to reduce the matrix when several elements '
+                                 'fall in one screen pixel: ``none`` (sample it), '
+                                 'or the ``mean`` or ``max`` of a pyramid level')
 
     def __init__(self, layer=None, viewer_state=None, **kwargs):
 
@@ -625,6 +684,13 @@ class HeatmapLayerState(BaseHeatmapLayerState):
         HeatmapLayerState.stretch.set_choices(self, ['linear', 'sqrt', 'arcsinh', 'log'])
         HeatmapLayerState.stretch.set_display_func(self, stretch_display.get)
 
+        lod_display = {'none': 'Sample',
+                       'mean': 'Mean',
+                       'max': 'Maximum'}
+
+        HeatmapLayerState.lod.set_choices(self, ['none', 'mean', 'max'])
+        HeatmapLayerState.lod.set_display_func(self, lod_display.get)
+
         self.add_callback('global_sync', self._update_syncing)
         self.add_callback('layer', self._update_attribute)
 
@@ -666,6 +732,17 @@ class HeatmapLayerState(BaseHeatmapLayerState):
     def _get_image(self, view=None):
         return self.layer[self.attribute, view]
 
+    def _get_lod_image(self, full_view):
+        # Pyramids are in the pixel frame of the layer, so only used for the reference data itself
+        if (self.lod == 'none' or self.attribute is None or
+                self.layer is not self.viewer_state.reference_data or self.layer.ndim != 2):
+            return None
+        pyramid = get_pyramid(self.layer, self.attribute, self.lod)
+        level = pyramid.choose_level(full_view)
+        if level == 0:
+            return None
+        return pyramid.sample(full_view, level)
+
     def flip_limits(self):
         """
         Flip the image levels.
@@ -683,12 +760,36 @@ class HeatmapSubsetLayerState(BaseHeatmapLayerState):
     A state class that includes all the attributes for subset layers in an image plot.
     """
 
-    # TODO: we can save memory by not showing subset multiple times for
-    # different image datasets since the footprint should be the same.
+    # Number of views whose masks are kept per subset state
+    mask_cache_size = 8
 
     def __init__(self, *args, **kwargs):
         self.uuid = str(uuid.uuid4())
         super(HeatmapSubsetLayerState, self).__init__(*args, **kwargs)
 
+    def get_sliced_data(self, view=None, bounds=None):
+        """
+        Return the mask of the subset in the current view.
+
+        Masks are cached per subset state, data, reference data, slices and
+        view, and shared by all the layers showing the same subset, e.g. in
+        several viewers. Editing a subset replaces its state, so only data
+        changes need `discard_subset_masks`. The returned mask must not be
+        modified.
+        """
+        viewer_state = self.viewer_state
+        key = (self.layer.data.uuid, viewer_state.reference_data.uuid,
+               viewer_state.x_att.axis, viewer_state.y_att.axis,
+               _freeze(viewer_state.slices), _freeze(view), _freeze(bounds))
+        masks = _SUBSET_MASKS.setdefault(self.layer.subset_state, OrderedDict())
+        if key in masks:
+            masks.move_to_end(key)
+            return masks[key]
+        mask = super(HeatmapSubsetLayerState, self).get_sliced_data(view=view, bounds=bounds)
+        masks[key] = mask
+        while len(masks) > self.mask_cache_size:
+            masks.popitem(last=False)
+        return mask
+
     def _get_image(self, view=None):
         return self.layer.to_mask(view=view)
@@ -1,9 +1,8 @@
 import os
-import operator
 import math
-#import numpy as np
+import numpy as np
 
-from glue.core.subset import roi_to_subset_state, InequalitySubsetState, MultiOrState, combine_multiple#, ElementSubsetState
+from glue.core.subset import roi_to_subset_state, combine_multiple#, ElementSubsetState
 from glue.core.coordinates import Coordinates, LegacyCoordinates
 from glue.core.coordinate_helpers import dependent_axes
 from glue.core.util import update_ticks
@@ -14,6 +13,7 @@ from glue.viewers.image.compat import update_image_viewer_state #This will not w
 from glue.viewers.image.frb_artist import imshow
 from glue.viewers.image.composite_array import CompositeArray
 
+from ..subsets import KeySetSubsetState
 from .layer_artist import HeatmapLayerArtist, HeatampSubsetLayerArtist
 
 
@@ -135,21 +135,23 @@ class MatplotlibHeatmapMixin(object):
         cmin = round(roi.min) # this is not exactly the same logic as roi_to_subset, but it works okay
         cmax = math.ceil(roi.max)
 
+        coords = self.state.reference_data.coords
         if roi.ori == 'x':
             selection_component_id = self.state.x_linked_attribute or self.state.x_real_attribute #select on linked_attribute if available, otherwise on real one
-            ticks = self.state.reference_data.coords.x_axis_ticks[cmin:cmax]
+            n_ticks = len(coords.x_axis_ticks)
             #selection_component_id = self.state.x_linked_attribute#.id['orsam_id']
 
         elif roi.ori == 'y':
             selection_component_id = self.state.y_linked_attribute or self.state.y_real_attribute
-            ticks = self.state.reference_data.coords.y_axis_ticks[cmin:cmax] 
+            n_ticks = len(coords.y_axis_ticks)
+
+        ticks = coords.pixel_to_tick(roi.ori, np.arange(max(cmin, 0), min(cmax, n_ticks)))
 
         # By far the most stable solution is to define the subset ON the metadata data set, which means
         # that we need a reference to it...
         
-
-        states = [InequalitySubsetState(selection_component_id, int(t), operator.eq) for t in ticks]
-        subset_state = MultiOrState(states)
+        # A single membership test rather than one equality state per tick
+        subset_state = KeySetSubsetState(selection_component_id, ticks.astype(int))
         #subset_state = ElementSubsetState(indices = np.array([0,30000]), data = self.state.reference_data)
 
         #from glue.core.command import ApplySubsetState
@@ -0,0 +1,103 @@
+"""
+Build manifests for the files written to ``.glue_index``.
+
+A manifest records the source file an index was built from (size,
+modification time and a content hash), the parameters of the build,
+and the size and modification time of the files of every level. This lets
+`BedGraph.index` and `BedPe.index` tell which levels are missing or stale
+and rebuild only those, and notice a changed source without parsing it.
+"""
+import hashlib
+import json
+import os
+
+__all__ = ['IndexManifest', 'content_hash']
+
+# Size of the reads of `content_hash`
+HASH_BLOCK_SIZE = 2 ** 20
+
+
+def content_hash(path):
+    """
+    Hash the whole content of a file, reading it in blocks.
+
+    This is only needed when a modification time changes without the size
+    changing, and unlike a sample of the file it catches any edit.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+class IndexManifest:
+    """
+    The manifest of the index of ``source``, stored as JSON at ``path``.
+
+    Parameters
+    ----------
+    path: Location of the manifest file
+    source: Path to the indexed source file
+    params: Dictionary of build parameters. Levels recorded with different
+        parameters are considered invalid.
+    """
+
+    def __init__(self, path, source, params):
+        self.path = path
+        self.source = source
+        self.params = params
+        self._source = None
+        self._levels = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored.get('params') == params:
+                self._source = stored.get('source')
+                self._levels = stored.get('levels', {})
+
+    def source_changed(self):
+        """Whether the source differs from the one the recorded levels were built from."""
+        if self._source is None:
+            return True
+        current = _stat(self.source)
+        if current['size'] != self._source['size']:
+            return True
+        if current['mtime'] == self._source['mtime']:
+            return False
+        if content_hash(self.source) != self._source['hash']:
+            return True
+        # Same content, e.g. the file was touched or copied: remember the new mtime
+        self._source['mtime'] = current['mtime']
+        return False
+
+    def level_valid(self, level, files):
+        """Whether ``level`` was recorded with exactly ``files``, all of them unchanged since."""
+        recorded = self._levels.get(str(level))
+        if recorded is None or sorted(recorded) != sorted(files):
+            return False
+        return all(os.path.exists(path) and _stat(path) == stat for path, stat in recorded.items())
+
+    def reset(self):
+        """Forget all levels, and record the current source."""
+        self._source = dict(_stat(self.source), hash=content_hash(self.source))
+        self._levels = {}
+
+    def invalidate(self, level):
+        self._levels.pop(str(level), None)
+
+    def record(self, level, files):
+        """Record ``files`` as the up to date output of ``level``."""
+        self._levels[str(level)] = {path: _stat(path) for path in files}
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'params': self.params, 'source': self._source, 'levels': self._levels}, f, indent=1)
+        os.replace(tmp, self.path)
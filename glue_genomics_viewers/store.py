@@ -0,0 +1,208 @@
+"""
+Binary, memory-mapped storage for multi-resolution interval tracks.
+
+Each zoom level of each chromosome is stored as one flat binary file per
+column, alongside a small JSON header::
+
+    <root>/header.json
+    <root>/<chrom>/<level>.<column>
+
+The header records the columns of every level with their dtypes and, per
+chromosome and level, the number of rows, the widest interval and the
+largest stop. Rows are sorted by start, and ``<level>.stop_max`` holds the
+running maximum of ``stop``, so a region query is two `numpy.searchsorted`
+calls followed by a slice of the memory-mapped columns, which is only copied
+when it contains intervals ending before the region.
+"""
+from glob import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['MemmapStore']
+
+RAW = 'raw'
+# Running maximum of the stop column, used to find the first overlapping row
+STOP_MAX = 'stop_max'
+
+
+class MemmapStore:
+    """
+    Read and write a memory-mapped interval store rooted at ``root``.
+
+    Levels are identified by integers, or `None` for the undecimated data.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._header = None
+        self._columns = {}
+
+    @property
+    def header_path(self):
+        return os.path.join(self.root, 'header.json')
+
+    def exists(self):
+        return os.path.exists(self.header_path)
+
+    @property
+    def header(self):
+        if self._header is None:
+            with open(self.header_path) as f:
+                self._header = json.load(f)
+        return self._header
+
+    def _column_path(self, chrom, level, column):
+        return os.path.join(self.root, chrom, f'{RAW if level is None else level}.{column}')
+
+    def writer(self, levels=None):
+        return MemmapStoreWriter(self, levels=levels)
+
+    def dtypes(self, level):
+        """The columns of ``level`` and their dtypes, not including ``chrom``."""
+        return self.header['dtypes'].get(RAW if level is None else str(level), {})
+
+    def level_files(self, level):
+        """Paths of the column files of ``level``, according to the header."""
+        if not self.exists():
+            return []
+        key = RAW if level is None else str(level)
+        return [self._column_path(chrom, level, column)
+                for chrom, levels in self.header['chroms'].items() if key in levels
+                for column in list(self.dtypes(level)) + ([STOP_MAX] if STOP_MAX in levels[key] else [])]
+
+    def iter_level(self, level, chunksize=None):
+        """Yield all rows of ``level`` in genomic order, as DataFrames of at most ``chunksize`` rows."""
+        key = RAW if level is None else str(level)
+        for chrom, levels in self.header['chroms'].items():
+            if key not in levels:
+                continue
+            n = levels[key]['n']
+            columns = {c: self._column(chrom, level, c, n) for c in self.dtypes(level)}
+            for lo in range(0, n, chunksize or n):
+                hi = min(lo + (chunksize or n), n)
+                yield pd.DataFrame({'chrom': np.full(hi - lo, chrom, dtype=object),
+                                    **{c: np.array(column[lo:hi]) for c, column in columns.items()}})
+
+    def _column(self, chrom, level, column, n):
+        key = chrom, level, column
+        if key not in self._columns:
+            dtype = np.dtype(self.dtypes(level)['stop' if column == STOP_MAX else column])
+            if n == 0:
+                self._columns[key] = np.zeros(0, dtype=dtype)
+            else:
+                self._columns[key] = np.memmap(self._column_path(chrom, level, column),
+                                               dtype=dtype, mode='r', shape=(n,))
+        return self._columns[key]
+
+    def query(self, level, gr):
+        """Return the rows of ``level`` overlapping ``gr`` as a DataFrame."""
+        dtypes = self.dtypes(level)
+        info = self.header['chroms'].get(gr.chrom, {}).get(RAW if level is None else str(level))
+        if info is None:
+            return pd.DataFrame({'chrom': _chrom_column(gr.chrom, 0),
+                                 **{c: np.zeros(0, dtype=d) for c, d in dtypes.items()}})
+
+        n = info['n']
+        start = self._column(gr.chrom, level, 'start', n)
+        if STOP_MAX in info:
+            lo = np.searchsorted(self._column(gr.chrom, level, STOP_MAX, n), gr.start, side='left')
+        else:
+            # Stores written before the running maximum was kept
+            lo = np.searchsorted(start, gr.start - info['max_span'], side='right')
+        hi = max(lo, np.searchsorted(start, gr.end, side='right'))
+
+        columns = {c: self._column(gr.chrom, level, c, n)[lo:hi] for c in dtypes}
+        # Rows after the first overlapping one may still end before the region
+        keep = columns['stop'] >= gr.start
+        if not keep.all():
+            columns = {c: column[keep] for c, column in columns.items()}
+        return pd.DataFrame({'chrom': _chrom_column(gr.chrom, len(columns['stop'])), **columns}, copy=False)
+
+
+def _chrom_column(chrom, n):
+    """A categorical column repeating ``chrom``, without materializing ``n`` strings."""
+    return pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[chrom])
+
+
+class MemmapStoreWriter:
+    """
+    Incrementally append sorted interval frames to a `MemmapStore`.
+
+    Frames for a given level must arrive in genomic order, but frames for
+    different levels may be interleaved. The header is only written by
+    `close`, so an interrupted build is never mistaken for a complete one.
+    Several writers (e.g. in different processes) may fill disjoint sets of
+    chromosomes of the same store; all but one should be created with
+    ``clear=False`` and report back to it through `update`.
+
+    If ``levels`` is given, only those levels are written and replaced: the
+    other levels of an existing store are kept, and frames written to them
+    are ignored.
+    """
+
+    def __init__(self, store, clear=True, levels=None):
+        self.store = store
+        self.dtypes = {}
+        self.chroms = {}
+        self.levels = None if levels is None else {RAW if level is None else str(level) for level in levels}
+        if not clear:
+            return
+        if self.levels is None or not store.exists():
+            shutil.rmtree(store.root, ignore_errors=True)
+            os.makedirs(store.root)
+            return
+
+        self.dtypes = {key: dtypes for key, dtypes in store.header['dtypes'].items() if key not in self.levels}
+        # Chromosomes keep their position, so that `MemmapStore.iter_level` stays in genomic order
+        for chrom, levels in store.header['chroms'].items():
+            self.chroms[chrom] = {key: info for key, info in levels.items() if key not in self.levels}
+        for key in self.levels:
+            for path in glob(os.path.join(store.root, '*', f'{key}.*')):
+                os.remove(path)
+
+    def write(self, level, df):
+        key = RAW if level is None else str(level)
+        if df.empty or (self.levels is not None and key not in self.levels):
+            return
+
+        dtypes = self.dtypes.setdefault(key, {c: df[c].dtype.str for c in df.columns if c != 'chrom'})
+
+        chrom = df['chrom'].to_numpy()
+        edges = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+        bounds = zip(np.concatenate([[0], edges]), np.concatenate([edges, [len(df)]]))
+
+        for lo, hi in bounds:
+            name = str(chrom[lo])
+            part = df.iloc[lo:hi]
+            os.makedirs(os.path.join(self.store.root, name), exist_ok=True)
+            for column, dtype in dtypes.items():
+                path = self.store._column_path(name, level, column)
+                with open(path, 'ab') as f:
+                    part[column].to_numpy(dtype=dtype).tofile(f)
+
+            span = int((part['stop'] - part['start']).max())
+            info = self.chroms.setdefault(name, {}).setdefault(key, {'n': 0, 'max_span': 0})
+            stop = part['stop'].to_numpy(dtype=dtypes['stop'])
+            stop_max = np.maximum.accumulate(np.maximum(stop, info.get(STOP_MAX, stop[0])))
+            with open(self.store._column_path(name, level, STOP_MAX), 'ab') as f:
+                stop_max.tofile(f)
+            info['n'] += int(hi - lo)
+            info['max_span'] = max(info['max_span'], span)
+            info[STOP_MAX] = int(stop_max[-1])
+
+    def update(self, dtypes, chroms):
+        """Merge the metadata of another writer that wrote disjoint chromosomes."""
+        self.dtypes.update(dtypes)
+        self.chroms.update(chroms)
+
+    def close(self):
+        tmp = self.store.header_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'dtypes': self.dtypes, 'chroms': self.chroms}, f)
+        os.replace(tmp, self.store.header_path)
+        self.store._header = None
+        self.store._columns.clear()
@@ -1,8 +1,14 @@
+from threading import Lock
+from weakref import WeakKeyDictionary
+
 from glue.core.state import SubsetState
 from glue.core.contracts import contract
+from glue.core.decorators import memoize
 from glue.core.exceptions import IncompatibleAttribute
 
 import numpy as np
+import pandas as pd
+from ncls import NCLS
 
 class GenomicMulitRangeSubsetState(SubsetState):
     """A subset state which is multiple GenomicRangeSubsetStates
@@ -10,10 +16,15 @@ class GenomicMulitRangeSubsetState(SubsetState):
     Currently this assumes that we define multiple GenomeRangeSubsetStates
     only as OR states from the Table Viewer; we should make this more
     general and probably this should be built as a bunch of GenomicRangeSubsetStates
-    
+
+    Membership tests go through `interval_index`, built once per state, so
+    that testing N positions against M ranges costs O((N + M) log M) rather
+    than one pass over the data per range.
     """
     def __init__(self, subsets):
         self._subsets = subsets
+        self._index = None
+        self._ncls = {}
         self.chroms = []
         self.starts = []
         self.ends = []
@@ -23,8 +34,130 @@ class GenomicMulitRangeSubsetState(SubsetState):
             self.ends.append(subset.end)
             
     def copy(self):
+        if self._subsets is None:
+            return GenomicMulitRangeSubsetState.from_arrays(self.chroms, self.starts, self.ends)
         return GenomicMulitRangeSubsetState(self._subsets)
-            
+
+    @classmethod
+    def from_arrays(cls, chroms, starts, ends, merge=True):
+        """
+        Build a state from arrays of range chromosomes, starts and ends,
+        without a `GenomicRangeSubsetState` per range.
+
+        With ``merge``, overlapping and touching ranges are merged, and the
+        ranges are stored sorted by chromosome and start.
+        """
+        chroms = np.asarray(chroms, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if merge and len(starts):
+            codes, uniques = pd.factorize(chroms, sort=True)
+            order = np.lexsort((starts, codes))
+            codes, starts, ends = codes[order], starts[order], ends[order]
+            reach = np.empty_like(ends)
+            for k in range(len(uniques)):
+                rows = codes == k
+                reach[rows] = np.maximum.accumulate(ends[rows])
+            # A range opens a new merged range unless it starts within the reach of the previous one
+            first = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (starts[1:] > reach[:-1])])
+            chroms = uniques[codes[first]].astype(object)
+            starts, ends = starts[first], np.maximum.reduceat(ends, first)
+
+        state = cls([])
+        state._subsets = None
+        state.chroms, state.starts, state.ends = chroms, starts, ends
+        return state
+
+    @property
+    def interval_index(self):
+        """
+        Per chromosome, the range starts in sorted order and the running
+        maximum of the corresponding ends.
+
+        A position ``p`` is in some range iff, with ``k`` the last range
+        starting at or before ``p``, the running maximum of ends at ``k`` is
+        at least ``p``.
+        """
+        if self._index is None:
+            chroms = np.asarray(self.chroms, dtype=object)
+            starts = np.asarray(self.starts)
+            ends = np.asarray(self.ends)
+            self._index = {}
+            for chrom in pd.unique(chroms):
+                sel = chroms == chrom
+                order = np.argsort(starts[sel], kind='stable')
+                self._index[chrom] = starts[sel][order], np.maximum.accumulate(ends[sel][order])
+        return self._index
+
+    def ncls(self, chrom):
+        """
+        Return an `NCLS` of the ranges on ``chrom`` (or `None` if there are
+        none), built on first use and kept for the lifetime of the state.
+        """
+        if chrom not in self._ncls:
+            chroms = np.asarray(self.chroms, dtype=object)
+            sel = np.flatnonzero(chroms == chrom)
+            self._ncls[chrom] = None if len(sel) == 0 else NCLS(
+                np.asarray(self.starts, dtype=np.int64)[sel],
+                np.asarray(self.ends, dtype=np.int64)[sel],
+                sel.astype(np.int64))
+        return self._ncls[chrom]
+
+    def overlaps(self, chrom, start, end):
+        """
+        Return the positions of the intervals ``[start, end)`` on ``chrom``
+        overlapping any range of the subset, in increasing order.
+        """
+        tree = self.ncls(chrom)
+        if tree is None or len(start) == 0:
+            return np.empty(0, dtype=np.int64)
+        positions = np.arange(len(start), dtype=np.int64)
+        return np.unique(tree.has_overlaps(np.asarray(start, dtype=np.int64),
+                                           np.asarray(end, dtype=np.int64), positions))
+
+    def ranges_in(self, chrom, start, end):
+        """
+        Return the slice of ``interval_index[chrom]`` that can contain
+        anything overlapping ``[start, end]``, found by binary search.
+        """
+        if chrom not in self.interval_index:
+            return slice(0, 0)
+        starts, max_ends = self.interval_index[chrom]
+        # Running maxima of ends are sorted too, so both bounds are binary searches
+        return slice(np.searchsorted(max_ends, start, side='left'),
+                     np.searchsorted(starts, end, side='right'))
+
+    def contains(self, chrom, start, stop=None, window=None):
+        """
+        Return a boolean mask of the intervals ``[start, stop]`` (or positions,
+        if ``stop`` is `None`) lying within a single range of the subset.
+
+        ``chrom`` is either a single chromosome name or an array of them. If
+        all intervals overlap a ``(window_start, window_end)`` ``window``, only
+        the ranges overlapping it are searched (see `ranges_in`).
+        """
+        start = np.asarray(start)
+        stop = start if stop is None else np.asarray(stop)
+        result = np.zeros(start.shape, dtype=bool)
+
+        if np.ndim(chrom) == 0:
+            groups = [(chrom, slice(None))]
+        else:
+            codes, uniques = pd.factorize(np.asarray(chrom).ravel())
+            groups = [(c, (codes == k).reshape(start.shape)) for k, c in enumerate(uniques)]
+
+        for c, rows in groups:
+            if c not in self.interval_index:
+                continue
+            starts, max_ends = self.interval_index[c]
+            if window is not None:
+                in_window = self.ranges_in(c, *window)
+                starts, max_ends = starts[in_window], max_ends[in_window]
+            k = np.searchsorted(starts, start[rows], side='right') - 1
+            result[rows] = (k >= 0) & (max_ends[np.maximum(k, 0)] >= stop[rows])
+        return result
+
+    @memoize
     @contract(data='isinstance(Data)', view='array_view')
     def to_mask(self, data, view=None):
         """
@@ -33,21 +166,82 @@ class GenomicMulitRangeSubsetState(SubsetState):
         chr, start, end: generic BED file regions
         chr, genome_position: a 3D GNOME model
         """
-        result = np.zeros(data.components[0].shape)
+        chrom = data['chr', view]
         try:
-            for c,s,e in zip(self.chroms, self.starts, self.ends):
-                result |= (data['chr'] == c) & (data['start'] >= s) & (data['start'] <= e)
-        except:
-            try:
-                for c,s,e in zip(self.chroms, self.starts, self.ends):
-                    result |= (data['chr'] == c) & (data['genome_position'] >= s) & (data['genome_position'] <= e)
-            except:
-                raise IncompatibleAttribute()            
-        if view is not None:
-            result = result[view]
-        return result
+            position = data['start', view]
+        except IncompatibleAttribute:
+            position = data['genome_position', view]
+        return self.contains(chrom, position)
+
+
+# Genomic ranges selected by general subset states, see `genomic_ranges`
+_RANGES = WeakKeyDictionary()
+_ranges_lock = Lock()
 
 
+def genomic_ranges(subset_state, datasets=None):
+    """
+    Evaluate a general subset state to the genomic ranges it selects.
+
+    The state is evaluated once on each of ``datasets`` that has ``chr`` and
+    ``start`` (and optionally ``end``) components, e.g. a table of genes
+    selected in a linked table or heatmap viewer. The selected rows become
+    ranges, which are merged into a `GenomicMulitRangeSubsetState` that
+    genome tracks can filter their intervals with. Rows without an ``end``
+    span a single base.
+
+    Subset states are replaced rather than modified when a selection
+    changes, so the result is cached per state and list of datasets.
+
+    Parameters
+    ----------
+    subset_state: The `SubsetState` to evaluate
+    datasets: The datasets to evaluate it on, e.g. those of a subset group.
+        Defaults to the datasets of the attributes the state depends on, which
+        some states (e.g. `InequalitySubsetState`) do not list.
+
+    Returns
+    -------
+    A `GenomicMulitRangeSubsetState`, or `None` if no dataset has genomic components
+    """
+    if datasets is None:
+        datasets = []
+        for attribute in subset_state.attributes:
+            parent = getattr(attribute, 'parent', None)
+            if parent is not None and all(parent is not other for other in datasets):
+                datasets.append(parent)
+
+    key = tuple(data.uuid for data in datasets)
+    with _ranges_lock:
+        cached = _RANGES.get(subset_state, {})
+        if key in cached:
+            return cached[key]
+
+    chroms, starts, ends = [], [], []
+    for data in datasets:
+        try:
+            chrom = data['chr']
+            start = data['start']
+            # get_mask rather than to_mask, to follow join_on_key links
+            mask = data.get_mask(subset_state)
+        except (IncompatibleAttribute, KeyError):
+            continue
+        try:
+            end = data['end']
+        except (IncompatibleAttribute, KeyError):
+            end = start + 1
+        chroms.append(np.asarray(chrom)[mask])
+        starts.append(np.asarray(start)[mask])
+        ends.append(np.asarray(end)[mask])
+
+    result = None
+    if chroms:
+        result = GenomicMulitRangeSubsetState.from_arrays(
+            np.concatenate(chroms), np.concatenate(starts), np.concatenate(ends))
+    with _ranges_lock:
+        _RANGES.setdefault(subset_state, {})[key] = result
+    return result
+
 
 class GenomicRangeSubsetState(SubsetState):
     """A subset state defined by a (chrom, start, end) triple.
@@ -99,3 +293,30 @@ class GenomicRangeSubsetState(SubsetState):
                 raise IncompatibleAttribute()
         return result
 
+
+class KeySetSubsetState(SubsetState):
+    """A subset state selecting the elements whose ``att`` value is one of ``keys``.
+
+    This replaces an OR of one equality state per key: the keys are kept
+    sorted, and membership of N values is tested by binary search in
+    O(N log K), in a single pass over the data.
+    """
+    def __init__(self, att, keys):
+        self.att = att
+        self.keys = np.unique(np.asarray(keys))
+
+    @property
+    def attributes(self):
+        return (self.att,)
+
+    def copy(self):
+        return KeySetSubsetState(self.att, self.keys)
+
+    @memoize
+    @contract(data='isinstance(Data)', view='array_view')
+    def to_mask(self, data, view=None):
+        values = np.asarray(data[self.att, view])
+        if len(self.keys) == 0:
+            return np.zeros(values.shape, dtype=bool)
+        k = np.minimum(np.searchsorted(self.keys, values), len(self.keys) - 1)
+        return self.keys[k] == values
@@ -0,0 +1,141 @@
+import operator
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from glue.core import Data, DataCollection
+from glue.core.subset import InequalitySubsetState
+
+from glue_genomics_viewers.data import BedGraph, BedgraphData, BedPe, GenomeRange
+
+
+class FrameBackend:
+    """Serve queries from in-memory level frames, keyed by level file."""
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def query(self, path, gr, columns, gr2=None):
+        df = self.frames[path[:-len('.bgz')]]
+        gr2 = gr2 or gr
+        inside = ((df.chrom1 == gr.chrom) & (df.start1 <= gr.end) & (df.end1 >= gr.start) &
+                  (df.start2 <= gr2.end) & (df.end2 >= gr2.start))
+        return df[inside].reset_index(drop=True).astype(columns)
+
+    def discard(self, path):
+        pass
+
+
+def make_loops(n, span, seed=0):
+    rng = np.random.default_rng(seed)
+    start1 = np.sort(rng.integers(0, span, n))
+    end1 = start1 + rng.integers(500, 5_000, n)
+    start2 = end1 + rng.lognormal(9, 1, n).astype(np.int64)
+    end2 = start2 + rng.integers(500, 5_000, n)
+    return pd.DataFrame({'chrom1': 'chr1', 'start1': start1, 'end1': end1,
+                         'chrom2': 'chr1', 'start2': start2, 'end2': end2,
+                         'value': rng.integers(1, 20, n)})
+
+
+def indexed_bedpe(tmp_path, loops):
+    """A `BedPe` whose levels and density tables are built in memory."""
+    engine = BedPe(str(tmp_path / 'loops.bedpe'))
+    engine.tile_cache = None
+    frames = {engine._level_path(None): loops}
+    density = {}
+    df = loops
+    for level in range(engine.depth):
+        df = engine.decimate_loops(df, engine.downsample_factor ** (level + 1))
+        frames[engine._level_path(level)] = df
+        for chrom, table in engine.loop_density(df, engine.density_bin).items():
+            density[f'{level}|{chrom}'] = table
+    engine.backend = FrameBackend(frames)
+    engine._density = density
+    return engine
+
+
+class FailingBackend:
+
+    def query(self, path, gr, columns, gr2=None):
+        raise AssertionError(f"{path} should not be opened")
+
+    def discard(self, path):
+        pass
+
+
+def test_bedpe_query_empty_coarse_level(tmp_path):
+    engine = indexed_bedpe(tmp_path, make_loops(1_000, 10_000_000))
+    gr = GenomeRange('chr1', 0, 10_000_000)
+    coarse = engine.depth - 1
+    assert len(engine.query(gr, level=coarse, verbose=False)) == 0
+
+    # Neither the density tables nor the empty text file let the level be opened
+    engine.backend = FailingBackend()
+    result = engine.query(gr, level=coarse, verbose=False)
+    assert len(result) == 0
+    assert result.dtypes.to_dict() == {c: pd.Series([], dtype=d).dtype for c, d in engine._result_dtypes.items()}
+
+    engine._density = None
+    os.makedirs(tmp_path / '.glue_index')
+    open(engine._level_path(coarse), 'w').close()
+    assert engine.density is None
+    assert len(engine.query(gr, level=coarse, verbose=False)) == 0
+
+
+def test_bedpe_query_narrow_diagonal_window(tmp_path):
+    # Short loops, dense near the diagonal, viewed through a window much
+    # narrower than a density bin
+    engine = indexed_bedpe(tmp_path, make_loops(80_000, 10_000_000))
+    gr = GenomeRange('chr1', 786_940, 836_940)
+    assert gr.end - gr.start < engine.density_bin
+
+    result = engine.query(gr, target=100, verbose=False)
+    assert 0 < len(result) <= 100
+
+    # Same as reading the levels coarse to fine until one exceeds the target
+    counts = [len(engine.query(gr, level=level, verbose=False)) for level in range(engine.depth)]
+    assert len(result) == max(count for count in counts if count <= 100)
+
+
+def test_bedgraph_query_level_without_summary_columns(tmp_path):
+    pysam = pytest.importorskip('pysam')
+
+    engine = BedGraph(str(tmp_path / 'signal.bedgraph'))
+    engine.tile_cache = None
+    raw = pd.DataFrame({'chrom': 'chr1', 'start': np.arange(0, 100_000, 10),
+                        'stop': np.arange(10, 100_010, 10), 'value': np.arange(10_000) % 7 * 1.})
+    raw.to_csv(engine.path, sep='\t', header=False, index=False)
+
+    # A level as indexed before the summary columns were added
+    os.makedirs(tmp_path / '.glue_index')
+    path = engine._level_path(0)
+    engine.decimate_frame(raw, 10)[engine.columns].to_csv(path, sep='\t', header=False, index=False)
+    pysam.tabix_compress(path, path + '.bgz')
+    pysam.tabix_index(path + '.bgz', preset='bed')
+
+    result = engine.query(GenomeRange('chr1', 0, 20_000))
+    assert list(result.columns) == engine.columns
+    assert len(result) == 2_000
+    np.testing.assert_array_equal(engine.statistic(result, 'max'), raw['value'][:2_000])
+    np.testing.assert_array_equal(engine.statistic(result, 'count'), 1)
+
+
+def test_bedgraph_profile_linked_table_selection(tmp_path):
+    path = str(tmp_path / 'signal.bedgraph')
+    pd.DataFrame({'chrom': 'chr1', 'start': np.arange(0, 10_000, 10), 'stop': np.arange(10, 10_010, 10),
+                  'value': 1.}).to_csv(path, sep='\t', header=False, index=False)
+    signal = BedgraphData(path, engine_options={'storage': 'memmap'})
+    signal.engine.tile_cache = None
+    signal.engine.index()
+
+    genes = Data(chr=['chr1', 'chr1', 'chr1'], start=[100, 2_000, 5_000], end=[200, 2_100, 5_100],
+                 score=[1, 7, 9], label='genes')
+    collection = DataCollection([signal, genes])
+    state = InequalitySubsetState(genes.id['score'], 5, operator.gt)
+    collection.new_subset_group(subset_state=state, label='high score')
+
+    result = signal.profile('1', 0, 10_000, subset_state=state)
+    assert len(result) == 20
+    assert set(result['start'] // 1_000) == {2, 5}